@@ -24,10 +24,29 @@ import sys
 import pwd
 import time
 import argparse
+import BaseHTTPServer
+import SocketServer
+import threading
 import csv
+import heapq
+import json
+import mmap
+import struct
+import bisect
+import re
+import socket
+import select
+import errno
+import resource
+import atexit
+import collections
+import multiprocessing
+import multiprocessing.pool
 
 # set this to 1 for debugging
 DEBUG = 0
+# where procfs is mounted, can be changed with "--proc-root"
+PROC_ROOT = "/proc"
 # we need to get the pagesize at this point
 PAGE_SIZE = os.sysconf("SC_PAGESIZE")
 # a map from /proc/PID/status memory-related fields into column headers
@@ -41,6 +60,195 @@ VM_STATUS_MAP = {
     'Exe': 'EXE',
     'Lib': 'LIB',
     'PTE': 'PTE'}
+# a map from /proc/PID/smaps_rollup fields into column headers, in the order
+# they are emitted. USS (Private_Clean + Private_Dirty) is computed.
+SMAPS_ROLLUP_MAP = [
+    ('Pss', 'PSS'),
+    ('Private_Clean', 'PRIV-C'),
+    ('Private_Dirty', 'PRIV-D'),
+    ('Shared_Clean', 'SHR-C'),
+    ('Shared_Dirty', 'SHR-D'),
+    ('Swap', 'SWAP')]
+SMAPS_ROLLUP_FIELDS = dict(SMAPS_ROLLUP_MAP)
+# running count of smaps_rollup reads and the seconds they took,
+# used to report the per-process cost of the PSS memory model, and the
+# number of reads that were refused (the processes of other users)
+SMAPS_ROLLUP_COST = [0, 0.0, 0]
+# the thread pool workers of "-j" update SMAPS_ROLLUP_COST concurrently
+SMAPS_ROLLUP_LOCK = threading.Lock()
+# the "--profile" counters, the profile itself is only created with the
+# option so that every counting site is a single check when it is off
+PROFILE_COUNTERS = ['files_opened', 'bytes_read', 'vanished', 'db_connects',
+                    'db_round_trips']
+PROFILE = None
+# size of the first read of a file in /proc, large enough to get
+# stat, statm, status and smaps_rollup in one go
+PROC_READ_SIZE = 4096
+# process titles of the postgres auxiliary processes and the backend type
+# they are reported as. the title of a process is "postgres: " followed by
+# one of these (older releases append " process"), or by
+# "user database host activity" for a client backend. the background
+# writer of releases before 10 is "writer process", which is matched
+# whole so that a user named "writer" is not taken for it.
+# matched in order, by prefix, on whole words: the prefix has to be the
+# whole title or be followed by a space, so a client backend of a user
+# named eg. "walsender_app" is not taken for a walsender.
+PG_BACKEND_TYPES = [
+    ('checkpointer', 'checkpointer'),
+    ('background writer', 'background writer'),
+    ('writer process', 'background writer'),
+    ('walwriter', 'walwriter'),
+    ('wal writer', 'walwriter'),
+    ('autovacuum launcher', 'autovacuum launcher'),
+    ('autovacuum worker', 'autovacuum worker'),
+    ('stats collector', 'stats collector'),
+    ('logical replication launcher', 'logical replication launcher'),
+    ('logical replication', 'logical replication worker'),
+    ('walsender', 'walsender'),
+    ('wal sender', 'walsender'),
+    ('walreceiver', 'walreceiver'),
+    ('wal receiver', 'walreceiver'),
+    ('walsummarizer', 'walsummarizer'),
+    ('archiver', 'archiver'),
+    ('startup', 'startup'),
+    ('parallel worker', 'parallel worker'),
+    ('logger', 'logger'),
+    ('io worker', 'io worker'),
+    ('slotsync worker', 'slotsync worker')]
+# the process types whose title does not change once it is set, so their
+# command line is cached between the scans (see ProcessCache)
+STABLE_TITLE_TYPES = ('other', 'checkpointer', 'background writer', 'walwriter',
+                      'autovacuum launcher', 'stats collector',
+                      'logical replication launcher', 'logger')
+# the aggregate reports that can be asked for with --report
+REPORTS = ['user', 'program', 'cpu', 'type', 'database', 'cluster', 'query']
+# backend types as stored in the history ring buffer, by index
+BACKEND_TYPE_CODES = ['other', 'postmaster', 'client backend']
+for dummy, backend_type in PG_BACKEND_TYPES:
+    if backend_type not in BACKEND_TYPE_CODES:
+        BACKEND_TYPE_CODES.append(backend_type)
+BACKEND_TYPE_INDEX = dict((t, i) for i, t in enumerate(BACKEND_TYPE_CODES))
+# layout of the history ring buffer file:
+# header: magic, version, record size, capacity, number of records written
+# records: timestamp, pid, backend type, starttime, ures, shared, vmsize,
+#          minflt, majflt, utime, stime
+# all sizes in kilobytes, all times but the timestamp in ticks
+HISTORY_MAGIC = 'PGMEMRB1'
+HISTORY_HEADER = struct.Struct('<8sIIQQ')
+HISTORY_RECORD = struct.Struct('<dIHxxQQQQQQQQ')
+# default number of records of a new history file (80 bytes each)
+HISTORY_SIZE = 256 * 1024
+# number of backends whose memory contexts are logged with
+# "--memory-contexts", unless "-n" is given
+MEMORY_CONTEXTS_TOP = 10
+# how long to wait for the backends to write their memory contexts to
+# the server log, in seconds
+MEMORY_CONTEXTS_WAIT = 2
+# lines of the server log written by pg_log_backend_memory_contexts()
+MEMORY_CONTEXTS_START = re.compile(r'logging memory contexts of PID (\d+)')
+MEMORY_CONTEXTS_LINE = re.compile(r'level: \d+; (.*?): (\d+) total in \d+ blocks')
+MEMORY_CONTEXTS_TOTAL = re.compile(r'Grand total: (\d+) bytes in \d+ blocks; \d+ free \(\d+ chunks\); (\d+) used')
+# what is replaced to turn a query into its fingerprint: comments are
+# dropped, literals (strings, dollar quoted strings, numbers) and parameters
+# become ?, quoted identifiers are kept, and lists of ? in IN are collapsed
+QUERY_TOKENS = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<quoted>"(?:[^"]|"")*")
+  | (?P<literal>\$\$.*?\$\$
+      | \$(?P<tag>[A-Za-z_]\w*)\$.*?\$(?P=tag)\$
+      | (?<![\w$])[Ee]'(?:[^'\\]|\\.|'')*'
+      | (?<![\w$])[BbXxNnUu]?&?'(?:[^']|'')*'
+      | \$\d+
+      | (?<![\w$.])\d+(?:\.\d*)?(?:[eE][-+]?\d+)?
+      | (?<![\w$])\.\d+(?:[eE][-+]?\d+)?)
+""", re.DOTALL | re.VERBOSE)
+QUERY_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+# number of distinct query texts whose fingerprint is kept
+FINGERPRINT_CACHE_SIZE = 4096
+# where cgroup v2 is mounted, the second one on hybrid hierarchies
+CGROUP_ROOTS = ['/sys/fs/cgroup', '/sys/fs/cgroup/unified']
+# fields of /proc/meminfo shown in the system memory section
+MEMINFO_FIELDS = ['MemTotal', 'MemAvailable', 'Shmem', 'Committed_AS',
+                  'CommitLimit', 'HugePages_Total', 'HugePages_Free',
+                  'HugePages_Rsvd', 'Hugepagesize']
+# fields of memory.stat shown in the cgroup section
+CGROUP_STAT_FIELDS = ['anon', 'file', 'shmem', 'file_dirty', 'file_writeback',
+                      'kernel', 'sock']
+# defaults of the "--watch" growth detector: URES growth rate in kilobytes
+# per second that flags a process, sample interval in seconds and the
+# weight of the newest sample in the moving average of the growth rate
+WATCH_GROWTH_RATE = 10 * 1024
+WATCH_INTERVAL = 1
+WATCH_ALPHA = 0.3
+# defaults of "--cpu-load": seconds between the two readings, and the
+# difference in busy percent between the least and most busy NUMA node
+# that is reported as an imbalance
+CPU_LOAD_DELAY = 1.0
+CPU_IMBALANCE = 25.0
+# where the kernel lists the cpus of each NUMA node
+NUMA_NODE_ROOT = '/sys/devices/system/node'
+# columns of a CSV capture used by "--diff"
+DIFF_COLUMNS = ['PID', 'UID', 'URES', 'VIRT', 'MINFLT', 'MAJFLT', 'started', 'CMD']
+# reports "--diff" can aggregate the changes by
+DIFF_REPORTS = ('user', 'program')
+# defaults of "--pressure-trigger": the PSI trigger (stall time and window
+# in microseconds, a window of a multiple of 2 seconds is also allowed
+# without privileges on recent kernels), the least number of seconds between
+# two captures, and the number of follow-up samples taken "-i" seconds apart
+# (default PRESSURE_BURST_INTERVAL) after the first one
+PRESSURE_TRIGGER = 'some 150000 2000000'
+PRESSURE_COOLDOWN = 60
+PRESSURE_BURST = 3
+PRESSURE_BURST_INTERVAL = 1
+# the kernel proc connector of "--events": the netlink protocol, the
+# multicast group and value of the process events, the listen operation,
+# and the events that are followed (fork, exec, exit)
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+PROC_CN_MCAST_LISTEN = 1
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_EXIT = 0x80000000
+NLMSG_DONE = 3
+# struct nlmsghdr, struct cn_msg and the header of struct proc_event
+NLMSG_HEADER = struct.Struct('=IHHII')
+CN_MSG_HEADER = struct.Struct('=IIIIHH')
+PROC_EVENT_HEADER = struct.Struct('=IIQ')
+PROC_EVENT_IDS = struct.Struct('=IIII')
+# the taskstats family of generic netlink, also used by "--events": the
+# exit record of every task carries its elapsed time and peak RSS
+NETLINK_GENERIC = 16
+NLM_F_REQUEST = 1
+NLM_F_ACK = 4
+NLMSG_ERROR = 2
+NLA_TYPE_MASK = 0x3fff
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+TASKSTATS_CMD_GET = 1
+TASKSTATS_CMD_ATTR_REGISTER_CPUMASK = 3
+TASKSTATS_TYPE_STATS = 3
+TASKSTATS_TYPE_AGGR_PID = 4
+# struct genlmsghdr, struct nlattr, and the fields of struct taskstats from
+# ac_pid on: ac_pid, ac_ppid, ac_btime, padding, ac_etime (microseconds),
+# ac_utime, ac_stime, ac_minflt, ac_majflt, coremem, virtmem, hiwater_rss (kB)
+GENL_HEADER = struct.Struct('=BBH')
+NLATTR_HEADER = struct.Struct('=HH')
+TASKSTATS_EXIT_OFFSET = 128
+TASKSTATS_EXIT = struct.Struct('=IIIIQQQQQQQQ')
+# seconds between the samples of the followed processes in "--events"
+EVENTS_INTERVAL = 1
+# refresh interval of the exporter snapshot, unless "-i" is given
+EXPORTER_INTERVAL = 15
+# buffer size of the output file, rows are written through one handle
+OUTPUT_BUFFER_SIZE = 64 * 1024
+# the tick unit of /proc/PID/stat times, which has been defined as 100 always
+USER_HZ = 100
+# how far (in seconds) backend_start from pg_stat_activity may be from the
+# process start time in /proc/PID/stat and still be considered the same process
+BACKEND_START_SLACK = 2
 
 
 class UsernameCache:
@@ -76,6 +284,167 @@ class UsernameCache:
 NAME_CACHE = UsernameCache()
 
 
+# utility to turn a query into its fingerprint, the shape of the query
+# without its literals, so the backends running the same statement with
+# other values can be grouped
+def normalize_query(query):
+    def replace(match):
+        if match.group('comment') is not None:
+            return ' '
+        if match.group('quoted') is not None:
+            return match.group('quoted')
+        return '?'
+    query = ' '.join(QUERY_TOKENS.sub(replace, query).split())
+    return QUERY_IN_LIST.sub('IN (...)', query)
+
+
+class FingerprintCache:
+    '''
+    Utility class to act as a bounded cache of query fingerprints.
+    The backends of a pool run the same few query texts over and over,
+    so these are only normalized once. The least recently used texts
+    are dropped beyond size entries.
+    '''
+    def __init__(self, size=FINGERPRINT_CACHE_SIZE):
+        self.size = size
+        self.fingerprints = collections.OrderedDict()
+
+    def get(self, query):
+        fingerprint = self.fingerprints.pop(query, None)
+        if fingerprint is None:
+            fingerprint = normalize_query(query)
+            if len(self.fingerprints) >= self.size:
+                self.fingerprints.popitem(last=False)
+        self.fingerprints[query] = fingerprint
+        return fingerprint
+
+
+FINGERPRINT_CACHE = FingerprintCache()
+
+
+# utility class to cache the command lines of the processes, for repeated
+# scans.
+# entries are keyed on (pid, starttime), so a reused pid is a new entry,
+# and evict() drops the entries of the processes that were not seen since
+# the previous call, so the cache does not outgrow the live processes.
+# exec() keeps the pid and start time, but changes the command name of
+# /proc/PID/stat (which is read anyway), so an entry is only used while
+# that is the same.
+# the command lines of the postgres processes are only cached for the
+# types in STABLE_TITLE_TYPES: the client backends rewrite their process
+# title with their activity, several auxiliary processes with their
+# progress, and a backend that has just been forked still has the title
+# of the postmaster. the owner is not cached either, as setuid() changes
+# it, it costs a stat() of /proc/PID.
+# a cached process costs its stat(), statm and stat reads, one read less
+# than without the cache. the backends of a pool are read in full.
+class ProcessCache:
+    def __init__(self):
+        # (pid, starttime) -> (command name, cmd)
+        self.entries = {}
+        self.seen = set()
+
+    # the command line of the process, None if it has to be read
+    def get(self, key, comm):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] != comm:
+            del self.entries[key]
+            return None
+        self.seen.add(key)
+        return entry[1]
+
+    def add(self, key, comm, cmd):
+        if classify_process(cmd)[0] not in STABLE_TITLE_TYPES:
+            return
+        self.entries[key] = (comm, cmd)
+        self.seen.add(key)
+
+    def evict(self):
+        for key in self.entries.keys():
+            if key not in self.seen:
+                del self.entries[key]
+        self.seen = set()
+
+
+# the /proc/PID/status columns, in the order of ProcessInfo.status_mem
+STATUS_MEM_COLUMNS = sorted(VM_STATUS_MAP.values())
+STATUS_MEM_INDEX = dict((label, i) for i, label in enumerate(STATUS_MEM_COLUMNS))
+
+
+# the information of one process, as returned by get_process_info (see
+# there for the fields). a process is tracked for every scanned pid, so
+# the fields are slots rather than a hash, and status_mem is a tuple in
+# the order of STATUS_MEM_COLUMNS (None where the kernel does not have
+# the field) rather than a hash of its own.
+# the postgres and cluster fields are None until they are attached.
+class ProcessInfo(object):
+    __slots__ = ('pid', 'ppid', 'uid', 'gid', 'vmsize', 'res', 'shared',
+                 'ures', 'cmd', 'state', 'minflt', 'majflt', 'utime', 'stime',
+                 'cpu', 'threads', 'starttime', 'exists_for', 'status_mem',
+                 'smaps', 'backend_type', 'backend_db', 'cluster',
+                 'cluster_info', 'qry_state', 'waiting_state', 'query',
+                 'mem_contexts')
+
+    def __init__(self):
+        self.status_mem = self.smaps = None
+        self.backend_type = self.backend_db = None
+        self.cluster = self.cluster_info = None
+        self.qry_state = self.waiting_state = self.query = None
+        self.mem_contexts = None
+
+    # the value of a /proc/PID/status column, None if it is not there
+    def status(self, label):
+        if self.status_mem is None:
+            return None
+        return self.status_mem[STATUS_MEM_INDEX[label]]
+
+    # the /proc/PID/status columns the process has
+    def status_labels(self):
+        if self.status_mem is None:
+            return []
+        return [label for label, value in zip(STATUS_MEM_COLUMNS, self.status_mem)
+                if value is not None]
+
+    # slots have no __dict__ to pickle, the process pool sends the records
+    # back as the list of their slots
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+# the options of the collection (get_process_infos), for using it without
+# the command line. these are the defaults of the options of the same name
+# of cli_parser(), and the parsed arguments can be passed instead.
+class CollectOptions:
+    DEFAULTS = {
+        'user': None,
+        'pgdata': None,
+        'postmaster_pid': None,
+        'pss': False,
+        'jobs': 1,
+        'pool': 'thread',
+        'all_clusters': False,
+        'postgres_query': False,
+        'memory_contexts': False,
+        'lines_of_output': None,
+        'pg_host': None,
+        'pg_port': None,
+        'pg_dbname': 'postgres',
+        'pg_user': 'postgres'}
+
+    def __init__(self, **options):
+        for name in options:
+            if name not in self.DEFAULTS:
+                raise TypeError('unknown collection option %r' % name)
+        for name, value in self.DEFAULTS.iteritems():
+            setattr(self, name, options.get(name, value))
+
+
 # utility class to aid in formatting
 # will calculate the necessary amount of left-justification for each
 # column based on the width of entries
@@ -121,8 +490,61 @@ class JustifiedTable:
                     self.output_row(0)
 
 
-# parse parameters
-def cli():
+# utility to check that the file out appends to has the columns of
+# header: the first line of a CSV file, or the keys of the first object
+# of a JSON Lines file. ends the run otherwise, the rows would not line
+# up with the columns of the file.
+def check_appended_header(out, header, json_lines=False):
+    f = open(out.name, 'rb')
+    try:
+        first = f.readline()
+    finally:
+        f.close()
+    try:
+        if json_lines:
+            columns = sorted(json.loads(first).keys())
+            expected = sorted(header)
+        else:
+            columns = next(csv.reader([first]))
+            expected = map(str, header)
+    except (ValueError, AttributeError, StopIteration):
+        columns = None
+    if columns != expected:
+        print '[ERROR] ' + out.name + ' has other columns than this output, not appending to it.'
+        sys.exit(1)
+
+
+# utility class to stream rows to a single open output handle
+# rows are written as CSV, or as JSON Lines (one JSON object per row,
+# keyed by the header) with json_lines.
+# CSV values are written as str() of the value, JSON keeps the numbers
+# as numbers and None as null.
+# without write_header rows are appended to a file that has some already,
+# which has to have the same columns.
+class RowWriter:
+    def __init__(self, out, header, json_lines=False, write_header=True):
+        self.out = out
+        self.header = header
+        self.json_lines = json_lines
+        if not write_header:
+            check_appended_header(out, header, json_lines)
+        if json_lines:
+            self.encoder = json.JSONEncoder(separators=(',', ':'))
+        else:
+            self.csvwriter = csv.writer(out)
+            if write_header:
+                self.csvwriter.writerow(header)
+
+    def write_row(self, row):
+        if self.json_lines:
+            self.out.write(self.encoder.encode(dict(zip(self.header, row))))
+            self.out.write('\n')
+        else:
+            self.csvwriter.writerow(map(str, row))
+
+
+# build the parameter parser
+def cli_parser():
     parser = argparse.ArgumentParser(description='pg_meminfo')
     parser.add_argument('-u', '--user', type=str,
                         help='Retrieve mem info for processes owned by a'
@@ -131,9 +553,19 @@ def cli():
                         dest='csv_output',
                         help='Convert the output to CSV. Default is to STDOUT, '
                         'otherwise supply a file that the script can write to.')
+    parser.add_argument('-J', '--json', action="store_true", default=False,
+                        dest='json_output',
+                        help='Like "-c", but emit JSON Lines: one JSON object '
+                        'per row, keyed by the column names.')
     parser.add_argument('-o', '--output', type=str, dest='output_file',
                         default='stdout', help='Output results to this file. '
                         'Default is to STDOUT.')
+    parser.add_argument('-a', '--append', action="store_true", default=False,
+                        dest='append',
+                        help='Append to the output file instead of replacing '
+                        'it. The header is only written if the file is empty, '
+                        'so samples of many runs can be collected in one file. '
+                        'A file with other columns is not appended to.')
     parser.add_argument('-s', '--sum-only', action="store_true", default=False,
                         dest='sum_only',
                         help='Emit the sum of the unique resident memory only. '
@@ -141,27 +573,286 @@ def cli():
     parser.add_argument('-p', '--postgres-query', action="store_true",
                         default=False, dest='postgres_query',
                         help='Retrieve the query currently executing for each '
-                        'process. Be aware there is overhead from querying '
-                        'the database for every pid, which adds time and '
-                        'resource overhead to the execution of this script. '
-                        'Getting the query per pid is more accurate than passing '
-                        'in a list of pids and returning the queries because '
-                        'transient queries might have completed by the time the '
-                        'call to pg_stat_activity is done, so queries that '
-                        'started after the pid was pulled from /proc but before '
-                        'the call to pg_stat_activity will not be the ones that '
-                        'are actually using the memory.')
+                        'process. A single pg_stat_activity snapshot is taken '
+                        'over one connection right after /proc is scanned. '
+                        'Rows are matched on pid and backend_start against the '
+                        'process start time, so a pid that was reused between '
+                        'the /proc scan and the snapshot does not pick up the '
+                        'query of an unrelated backend.')
+    parser.add_argument('-m', '--memory-contexts', action="store_true",
+                        default=False, dest='memory_contexts',
+                        help='On PostgreSQL 14+, have the top "-n" (default '
+                        '%d) backends by memory log their memory contexts '
+                        'with pg_log_backend_memory_contexts() over the "-p" '
+                        'connection, and, when the server log can be read, '
+                        'show the memory used by the contexts and the biggest '
+                        'context next to the query. The backends are then '
+                        'logged one at a time, within %d seconds in all. '
+                        'Implies "-p". '
+                        'Needs superuser or EXECUTE on the function.'
+                        % (MEMORY_CONTEXTS_TOP, MEMORY_CONTEXTS_WAIT))
+    parser.add_argument('--pg-host', type=str, default=None, dest='pg_host',
+                        help='Host or socket directory "-p" connects to. '
+                        'Default is the libpq default, or with '
+                        '"--all-clusters" the socket directory of each '
+                        'cluster.')
+    parser.add_argument('--pg-port', type=int, default=None, dest='pg_port',
+                        help='Port "-p" connects to. Default is the libpq '
+                        'default, or with "--all-clusters" the port of each '
+                        'cluster.')
+    parser.add_argument('--pg-dbname', type=str, default='postgres',
+                        dest='pg_dbname',
+                        help='Database "-p" connects to. Default is postgres.')
+    parser.add_argument('--pg-user', type=str, default='postgres',
+                        dest='pg_user',
+                        help='User "-p" connects as. Default is postgres.')
+    parser.add_argument('--all-clusters', action="store_true", default=False,
+                        dest='all_clusters',
+                        help='Assign every process to the cluster of the '
+                        'postmaster it descends from and, with "-p", query '
+                        'each cluster found for its own backends, '
+                        'concurrently, over one connection per cluster. '
+                        'Use "-r cluster" for the per-cluster totals.')
     parser.add_argument('-n', '--lines', default=None, dest='lines_of_output',
                         help='Retrieve only n lines of output. Default is all.')
+    parser.add_argument('--pss', action="store_true", default=False,
+                        dest='pss',
+                        help='Also read /proc/PID/smaps_rollup (Linux 4.14+) '
+                        'and report the proportional set size, private and '
+                        'shared pages and swap of every process. Pages of '
+                        'shared_buffers are split between the backends that '
+                        'touched them, so the PSS sum is a usable total. '
+                        'Rows are sorted by PSS and "-s" reports the PSS sum.')
+    parser.add_argument('-D', '--pgdata', type=str, default=None,
+                        dest='pgdata',
+                        help='Only look at the postmaster of this data '
+                        'directory (from its postmaster.pid) and the '
+                        'processes descending from it, instead of scanning '
+                        'every process on the host.')
+    parser.add_argument('-P', '--postmaster-pid', type=int, default=None,
+                        dest='postmaster_pid',
+                        help='Like "-D", but give the pid of the postmaster '
+                        'directly.')
+    parser.add_argument('--system', action="store_true", default=False,
+                        dest='system',
+                        help='Also show (with the table, "-s" or "-r") the '
+                        'memory headroom of the host from /proc/meminfo (MemAvailable, Shmem, huge pages, '
+                        'Committed_AS against CommitLimit) and of the cgroup '
+                        'v2 of the postmaster given with "-D"/"-P" or of '
+                        '"--cgroup" (memory.current, memory.max, '
+                        'memory.stat). Only with the text output of a single '
+                        'run, "--headroom" writes it as CSV/JSON.')
+    parser.add_argument('--headroom', action="store_true", default=False,
+                        dest='headroom',
+                        help='Only show what "--system" shows, without '
+                        'looking at the processes at all. Cheap enough for '
+                        'high-frequency health checks.')
+    parser.add_argument('--cgroup', type=str, default=None, dest='cgroup',
+                        help='cgroup v2 to report, as in /proc/PID/cgroup '
+                        '(eg. /system.slice/postgresql.service) or as a '
+                        'directory under the cgroup mount.')
+    parser.add_argument('-r', '--report', action='append', default=None,
+                        dest='reports', choices=REPORTS,
+                        help='Instead of the process table, report the '
+                        'process count, memory total, average, the top '
+                        'consumer and the page faults grouped by user, program name, last cpu, '
+                        'postgres backend type (client backend, autovacuum '
+                        'worker, walsender, checkpointer, ...) or by '
+                        'user@database of the client backends, or by the '
+                        'cluster (data directory) a process belongs to, or '
+                        'by query fingerprint: the query of the backends '
+                        'with its literals replaced and IN lists collapsed '
+                        '(implies "-p"). Can be given more than once.')
+    parser.add_argument('--exporter-port', type=int, default=None,
+                        dest='exporter_port',
+                        help='Serve Prometheus metrics on /metrics on this '
+                        'port instead of printing a report. The processes '
+                        'are collected by a background thread every "-i" '
+                        'seconds (default %d) and scrapes are answered from '
+                        'that snapshot. With "-r query" the backends are '
+                        'also summed per query fingerprint.' % EXPORTER_INTERVAL)
+    parser.add_argument('--exporter-address', type=str, default='127.0.0.1',
+                        dest='exporter_address',
+                        help='Address the exporter listens on. '
+                        'Default is 127.0.0.1.')
+    parser.add_argument('--top-k', type=int, default=10, dest='top_k',
+                        help='Number of processes the exporter reports '
+                        'individually, the others are only part of the '
+                        'per-type and per-user totals. Default is 10.')
+    parser.add_argument('--history', type=str, default=None,
+                        dest='history_file',
+                        help='Append every collected process to this '
+                        'fixed-size, memory-mapped ring buffer file. Once '
+                        'it is full the oldest records are overwritten.')
+    parser.add_argument('--history-size', type=int, default=HISTORY_SIZE,
+                        dest='history_size',
+                        help='Number of records of the ring buffer when it is '
+                        'created (%d bytes each). Default is %d.'
+                        % (HISTORY_RECORD.size, HISTORY_SIZE))
+    parser.add_argument('--history-report', action="store_true", default=False,
+                        dest='history_report',
+                        help='Instead of collecting, report the peak, average '
+                        'and growth of URES per process from the "--history" '
+                        'file, or per backend type with "-r type".')
+    parser.add_argument('--since', type=float, default=None, dest='since',
+                        help='Only use the last SINCE seconds of the history '
+                        'in "--history-report". Default is all of it.')
+    parser.add_argument('--diff', type=str, nargs=2, default=None,
+                        dest='diff', metavar=('OLD', 'NEW'),
+                        help='Instead of collecting, compare two CSV captures '
+                        'of "-c -o" and report the new, exited and grown '
+                        'processes (matched on PID and started) with their '
+                        'URES, VIRT and fault deltas, or with "-r user" or '
+                        '"-r program" the change per group. Captures sorted '
+                        'by PID are merged in constant memory, others are '
+                        'joined through a hash of OLD.')
+    parser.add_argument('--watch', action="store_true", default=False,
+                        dest='watch',
+                        help='Watch for processes whose URES grows quickly '
+                        '(eg. a runaway work_mem or hash join) every "-i" '
+                        'seconds (default %d) and report them, with their '
+                        'query with "-p", once they cross "--growth-rate" or '
+                        '"--ures-limit".' % WATCH_INTERVAL)
+    parser.add_argument('--growth-rate', type=float, default=WATCH_GROWTH_RATE,
+                        dest='growth_rate',
+                        help='URES growth in kilobytes per second, averaged '
+                        'over the recent samples, that "--watch" reports. '
+                        'Default is %d.' % WATCH_GROWTH_RATE)
+    parser.add_argument('--ures-limit', type=int, default=None,
+                        dest='ures_limit',
+                        help='URES in kilobytes that "--watch" reports, '
+                        'regardless of the growth rate.')
+    parser.add_argument('--ewma-alpha', type=float, default=WATCH_ALPHA,
+                        dest='ewma_alpha',
+                        help='Weight of the newest sample in the moving '
+                        'average of the growth rate, between 0 and 1. Higher '
+                        'reacts faster but is noisier. Default is %s.'
+                        % WATCH_ALPHA)
+    parser.add_argument('--cpu-load', type=float, nargs='?', default=None,
+                        const=CPU_LOAD_DELAY, dest='cpu_load',
+                        metavar='SECONDS',
+                        help='Take two readings SECONDS apart (default %(const)s) '
+                        'and report CPU%% per process next to its URES, and '
+                        'the load per backend type, per core and per NUMA '
+                        'node, flagging nodes that are unevenly loaded. The '
+                        'second reading only looks at the processes found '
+                        'by the first.')
+    parser.add_argument('--profile', type=str, nargs='?', default=None,
+                        const='stderr', dest='profile', metavar='FILE',
+                        help='Measure the wall and cpu time of every phase '
+                        '(discovery, parsing, postgres, sorting, formatting) '
+                        'and count the files opened, bytes read, processes '
+                        'that vanished during the scan and database round '
+                        'trips. Written to stderr, or appended to FILE as '
+                        'one JSON object per run.')
+    parser.add_argument('--pressure-trigger', type=str, nargs='?', default=None,
+                        const=PRESSURE_TRIGGER, dest='pressure_trigger',
+                        metavar='TRIGGER',
+                        help='Sleep until the memory pressure (PSI) of the '
+                        'host, or of the cgroup with "--cgroup"/"-D", crosses '
+                        'TRIGGER ("some|full STALL_US WINDOW_US", default '
+                        '"%s"), then write every process with its query to a '
+                        'file in "--pressure-dir", followed by "--burst" more '
+                        'samples "-i" seconds apart.' % PRESSURE_TRIGGER)
+    parser.add_argument('--pressure-dir', type=str, default='.',
+                        dest='pressure_dir',
+                        help='Where "--pressure-trigger" writes its captures. '
+                        'Default is the current directory.')
+    parser.add_argument('--cooldown', type=float, default=PRESSURE_COOLDOWN,
+                        dest='cooldown',
+                        help='Least number of seconds between two captures of '
+                        '"--pressure-trigger". Default is %d.' % PRESSURE_COOLDOWN)
+    parser.add_argument('--burst', type=int, default=PRESSURE_BURST,
+                        dest='burst',
+                        help='Number of samples taken after the first one of a '
+                        '"--pressure-trigger" capture. Default is %d.'
+                        % PRESSURE_BURST)
+    parser.add_argument('--events', action="store_true", default=False,
+                        dest='events',
+                        help='Follow the postgres processes through the fork, '
+                        'exec and exit events of the kernel proc connector '
+                        '(netlink, needs root) instead of rescanning /proc, '
+                        'sample their memory every "-i" seconds (default %d) '
+                        'and report the lifetime and peak URES of every one '
+                        'that exits, short-lived backends included. The '
+                        'children that exec something else than postgres '
+                        '(eg. an archive_command) are not followed. The exact '
+                        'lifetime and VmHWM at exit are read from the '
+                        'taskstats exit records of the kernel. Without '
+                        'taskstats, the peak of a backend that lives for '
+                        'less than the interval is not measured, only its '
+                        'memory at fork and exec. Falls back to scanning '
+                        '/proc every "-i" seconds when the proc connector is '
+                        'not available.' % EVENTS_INTERVAL)
+    parser.add_argument('--proc-root', type=str, default='/proc',
+                        dest='proc_root',
+                        help='Read the processes from this directory instead '
+                        'of /proc, eg. a synthetic tree for benchmarks.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, dest='jobs',
+                        help='Split the /proc scan across JOBS workers and '
+                        'merge their results. Default is 1, a serial scan.')
+    parser.add_argument('--pool', choices=['thread', 'process'],
+                        default='thread', dest='pool',
+                        help='Kind of worker pool used when "-j" is more '
+                        'than 1. Threads are cheap to start but share the '
+                        'interpreter lock, processes scale with cores but '
+                        'pay to start and to ship results back. '
+                        'Default is thread.')
+    parser.add_argument('-i', '--interval', type=float, default=None,
+                        dest='interval',
+                        help='Keep running and take a sample every INTERVAL '
+                        'seconds, reporting per-process deltas and rates of '
+                        'URES, page faults and CPU time between samples.')
+    parser.add_argument('--count', type=int, default=None, dest='count',
+                        help='Stop after COUNT intervals have been reported. '
+                        'Only used with --interval. Default is to run until '
+                        'interrupted.')
+
+    return parser
+
+
+# parse parameters
+def cli():
+    return cli_parser().parse_args()
+
 
-    return parser.parse_args()
+# utility to change where procfs is read from
+def set_proc_root(proc_root):
+    global PROC_ROOT
+    PROC_ROOT = proc_root.rstrip('/') or '/'
+
+
+# utility to read a whole file from /proc
+# this is done with a single os.read() in the common case, which avoids
+# building a python file object and its read buffers for every file.
+# files in /proc are generated on read and report a size of 0, so we
+# keep reading until the kernel has nothing more to give.
+def read_proc_file(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        data = os.read(fd, PROC_READ_SIZE)
+        if len(data) == PROC_READ_SIZE:
+            chunks = [data]
+            while True:
+                chunk = os.read(fd, PROC_READ_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            data = b''.join(chunks)
+    finally:
+        os.close(fd)
+    if PROFILE is not None:
+        PROFILE.count_file(len(data))
+    return data
 
 
 # utility to read a file
+# returns the first line, up to the first NUL (cmdline)
 def parse_file(filename):
-    f = open(filename, "rb")
-    line = f.readline()
-    del f
+    line = read_proc_file(filename)
+    i = line.find(b'\n')
+    if i != -1:
+        line = line[:i + 1]
     i = line.find(b'\x00')
     if i == -1:
         return line
@@ -170,95 +861,346 @@ def parse_file(filename):
 
 # utility to read and parse a comma delimited file (meminfo)
 def parse_split_file(filename):
-    f = open(filename, "rb")
-    lines = f.readlines()
-    del f
-
-    lines = map(lambda x: x.strip().split(), lines)
+    lines = read_proc_file(filename).splitlines()
+    lines = map(lambda x: x.split(), lines)
     return lines
 
 
 # utility to parse a file which contains one line with delim entries
 def parse_delim_file(filename):
-    f = open(filename, "rb")
-    line = f.readline()
-    del f
-
-    return line.split()
+    data = read_proc_file(filename)
+    i = data.find(b'\n')
+    if i != -1:
+        data = data[:i]
+    return data.split()
 
 
 # utility to parse a file which contains one line with delim numbers
 def parse_number_file(filename):
-    f = open(filename, "rb")
-    line = f.readline()
-    del f
+    return map(int, parse_delim_file(filename))
 
-    return map(int, line.split())
+
+# utility to pick "Label:   1234 kB" -entries out of the contents of a
+# file like /proc/PID/status, /proc/PID/smaps_rollup or /proc/meminfo
+# without splitting every line of it.
+# fields maps the label (without prefix) to the key used in the result.
+# only lines that start with prefix are looked at.
+def parse_kb_fields(data, fields, prefix=''):
+    ret = {}
+    marker = b'\n' + prefix
+    skip = len(marker)
+    i = data.find(marker)
+    while i != -1:
+        colon = data.find(b':', i)
+        if colon == -1:
+            break
+        end = data.find(b'\n', colon)
+        if end == -1:
+            end = len(data)
+        key = fields.get(data[i + skip:colon])
+        if key is not None:
+            value = data[colon + 1:end]
+            if value.endswith(b' kB'):
+                value = value[:-3]
+            ret[key] = int(value)
+        i = data.find(marker, end)
+    return ret
+
+
+# utility to parse /proc/PID/stat
+# returns the command name and the list of fields that follow it.
+# the command name is in parentheses and can itself contain spaces and
+# parentheses, so the fields start after the last ')'. index 0 of the
+# field list is the state (field 3 in proc(5)).
+def parse_stat_file(filename):
+    data = read_proc_file(filename)
+    lparen = data.find(b'(')
+    rparen = data.rfind(b')')
+    return data[lparen + 1:rparen], data[rparen + 2:].split()
 
 
 # return a hash of 'COLUMN-NAME': value -entries for
 # process specific memory info
 def get_process_mem_from_status(pid):
-    ret = {}
-    lines = parse_split_file("/proc/%d/status" % pid)
+    ret = parse_kb_fields(read_proc_file("%s/%d/status" % (PROC_ROOT, pid)),
+                          VM_STATUS_MAP, 'Vm')
+    for k, v in ret.items():
+        if v > 4 * 1024 * 1024:
+            ret[k] = -1
+    if len(ret) == 0:
+        return None
+    return ret
 
-    for line in lines:
-        if line[0][:2] == 'Vm':
-            vm_label = line[0][2:-1]
-            if vm_label in VM_STATUS_MAP:
-                v = int(line[1])
-                if v > 4 * 1024 * 1024:
-                    v = -1
-                ret[VM_STATUS_MAP[vm_label]] = v
+
+# return a hash of 'COLUMN-NAME': value -entries from
+# /proc/PID/smaps_rollup, which holds the smaps totals of the process
+# in one short file (unlike /proc/PID/smaps which lists every mapping)
+# "USS" is the sum of the private pages
+# will return None if smaps_rollup is not available or cannot be read
+def get_process_mem_from_smaps_rollup(pid):
+    started = time.time()
+    try:
+        data = read_proc_file("%s/%d/smaps_rollup" % (PROC_ROOT, pid))
+    except (IOError, OSError) as err:
+        if err.errno in (errno.EACCES, errno.EPERM):
+            with SMAPS_ROLLUP_LOCK:
+                SMAPS_ROLLUP_COST[2] += 1
+        return None
+    # the first line is the address range of the [rollup] pseudo-mapping,
+    # so every field is preceded by a newline
+    ret = parse_kb_fields(data, SMAPS_ROLLUP_FIELDS)
+    with SMAPS_ROLLUP_LOCK:
+        SMAPS_ROLLUP_COST[0] += 1
+        SMAPS_ROLLUP_COST[1] += time.time() - started
     if len(ret) == 0:
         return None
+    ret["USS"] = ret.get("PRIV-C", 0) + ret.get("PRIV-D", 0)
     return ret
 
 
-def get_postgres_query(pid):
-    '''This function will only return results if "track_activities" is enabled'''
+# the open connections to the clusters, by connection string
+# they are kept for the whole run, so sampling modes reuse them
+POSTGRES_CONNECTIONS = {}
+
+
+# utility to build a libpq connection string
+def get_postgres_dsn(dbname='postgres', user='postgres', host=None, port=None):
+    dsn = "dbname='%s' user='%s'" % (dbname, user)
+    if host:
+        dsn += " host='%s'" % host
+    if port:
+        dsn += " port=%d" % port
+    return dsn
+
+
+# utility to return the open connection for a connection string, or
+# open one
+def get_postgres_connection(dsn):
     import psycopg2
 
+    conn = POSTGRES_CONNECTIONS.get(dsn)
+    if conn is None or conn.closed:
+        conn = psycopg2.connect(dsn)
+        profile_count('db_connects')
+        conn.set_session(readonly=True)
+        POSTGRES_CONNECTIONS[dsn] = conn
+    return conn
+
+
+def get_postgres_activity(log_pids=None, dsn=None):
+    '''
+    Return a snapshot of pg_stat_activity as a hash keyed by pid:
+    pid -> (backend_start epoch, qry_state, waiting_state, query)
+    Only one connection and one pg_stat_activity scan is used per call,
+    rather than one round-trip per process. The connection to dsn is
+    kept open for the next call.
+    This function will only return results if "track_activities" is enabled
+
+    If log_pids is given, the memory contexts of those backends are logged
+    over the same connection (see log_memory_contexts) and the second
+    entry of the returned tuple holds their summaries:
+    pid -> (kilobytes used by the contexts, biggest context)
+    '''
+    import psycopg2
+
+    if dsn is None:
+        dsn = get_postgres_dsn()
     conn = None
+    activity = {}
+    contexts = {}
     try:
         qry_version = "SELECT current_setting('server_version_num')"
-        qry_pre_96 = "select state as qry_state, coalesce(waiting::text,'') as waiting_state, query from pg_catalog.pg_stat_activity WHERE pid = %s"
-        qry_96_up = "select state as qry_state, (case when wait_event_type is not null then wait_event_type || ':' || coalesce(wait_event,'')  else '' end) as waiting_state, query from pg_catalog.pg_stat_activity where pid = %s"
-        conn = psycopg2.connect("dbname='postgres' user='postgres'")
-        conn.set_session(readonly=True)
+        qry_pre_96 = "select pid, extract(epoch from backend_start), state as qry_state, coalesce(waiting::text,'') as waiting_state, query from pg_catalog.pg_stat_activity"
+        qry_96_up = "select pid, extract(epoch from backend_start), state as qry_state, (case when wait_event_type is not null then wait_event_type || ':' || coalesce(wait_event,'')  else '' end) as waiting_state, query from pg_catalog.pg_stat_activity"
+        conn = get_postgres_connection(dsn)
         cur = conn.cursor()
         cur.execute(qry_version)
+        profile_count('db_round_trips')
         ver = cur.fetchone()
-        if int(ver[0]) >= 9200 and int(ver[0]) < 90600:
+        if int(ver[0]) >= 90200 and int(ver[0]) < 90600:
             qry = qry_pre_96
         elif int(ver[0]) >= 90600:
             qry = qry_96_up
         else:
-            if conn:
-                conn.close()
-            return
-
-        # get the stats from the db
-        cur.execute(qry,(pid,))
-        row = cur.fetchone()
-        if row:
-            qry_state = row[0]
-            waiting_state = row[1]
-            query = row[2]
-            return qry_state, waiting_state, query
-
-    except psycopg2.DatabaseError, e:
-        print 'Error %s' % e
-        sys.exit(1)
+            return activity, contexts
+
+        # get the stats from the db, for all backends in one pass
+        cur.execute(qry)
+        profile_count('db_round_trips')
+        for row in cur.fetchall():
+            if row[0] is None:
+                continue
+            backend_start = None
+            if row[1] is not None:
+                backend_start = float(row[1])
+            activity[int(row[0])] = (backend_start, row[2], row[3], row[4])
+
+        if log_pids:
+            if int(ver[0]) >= 140000:
+                contexts = log_memory_contexts(cur, [p for p in log_pids if p in activity])
+            else:
+                print >> sys.stderr, '[WARNING] Memory contexts can only be logged on PostgreSQL 14 and up.'
 
-    finally:
+    except psycopg2.DatabaseError:
         if conn:
             conn.close()
+            del POSTGRES_CONNECTIONS[dsn]
+        raise
+
+    finally:
+        # end the transaction, so the next call gets a fresh snapshot of
+        # pg_stat_activity
+        if conn and not conn.closed:
+            conn.rollback()
+            profile_count('db_round_trips')
+
+    return activity, contexts
+
+
+# utility to turn log_line_prefix into a pattern that picks the pid out
+# of the prefix of a log line, None if the prefix has no %p
+def get_log_pid_pattern(log_line_prefix):
+    if not re.search(r'%-?\d*p', log_line_prefix or ''):
+        return None
+    pattern = ''
+    captured = False
+    for part in re.split(r'(%-?\d*.)', log_line_prefix):
+        if re.match(r'%-?\d*p$', part) and not captured:
+            pattern += r'\s*(\d+)\s*'
+            captured = True
+        elif part == '%%':
+            pattern += '%'
+        elif part.startswith('%'):
+            pattern += '.*?'
+        else:
+            pattern += re.escape(part)
+    return re.compile(pattern)
+
+
+# utility to have backends log their memory contexts and read the result
+# back from the server log.
+# the backends write their contexts to the server log when they next
+# check for interrupts, so when the current log file can be read from
+# here (logging_collector, and running as postgres or root) the backends
+# are signalled with pg_log_backend_memory_contexts() one at a time, and
+# the log is followed until the "Grand total" of that backend. the output
+# of backends signalled together would interleave in the log, and the
+# lines of the dump do not carry the pid unless log_line_prefix has it.
+# when it does (%p), the lines of other backends (eg. signalled by another
+# session) are skipped as well.
+# without a readable log all of the pids are signalled in one statement.
+# all of the backends share MEMORY_CONTEXTS_WAIT, the ones that are not
+# reached in that time are not logged.
+# returns a hash of pid -> (kilobytes used, name of the biggest context),
+# backends that were logged but not found in the log get (None, None).
+def log_memory_contexts(cur, pids):
+    if not pids:
+        return {}
+    logfile = None
+    offset = 0
+    cur.execute("SELECT current_setting('data_directory'), pg_current_logfile(), "
+                "current_setting('log_line_prefix')")
+    profile_count('db_round_trips')
+    data_directory, current_logfile, log_line_prefix = cur.fetchone()
+    log_pid = get_log_pid_pattern(log_line_prefix)
+    if current_logfile:
+        logfile = os.path.join(data_directory, current_logfile)
+        try:
+            offset = os.path.getsize(logfile)
+            fd = os.open(logfile, os.O_RDONLY)
+        except OSError:
+            logfile = None
+
+    contexts = {}
+    if logfile is None:
+        cur.execute("SELECT p, pg_catalog.pg_log_backend_memory_contexts(p) "
+                    "FROM unnest(%s::int[]) AS p", (list(pids),))
+        profile_count('db_round_trips')
+        for pid, logged in cur.fetchall():
+            if logged:
+                contexts[pid] = (None, None)
+        return contexts
+
+    deadline = time.time() + MEMORY_CONTEXTS_WAIT
+    buf = ''
+    try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        for pid in pids:
+            if time.time() >= deadline:
+                break
+            cur.execute("SELECT pg_catalog.pg_log_backend_memory_contexts(%s)", (pid,))
+            profile_count('db_round_trips')
+            if not cur.fetchone()[0]:
+                continue
+            contexts[pid] = (None, None)
+            # [biggest context, its total] once the dump of pid started
+            current = None
+            while time.time() < deadline and contexts[pid][0] is None:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    time.sleep(0.01)
+                    continue
+                lines = (buf + chunk).split('\n')
+                buf = lines.pop()
+                for line in lines:
+                    if log_pid is not None:
+                        m = log_pid.match(line)
+                        if m and int(m.group(1)) != pid:
+                            continue
+                    m = MEMORY_CONTEXTS_START.search(line)
+                    if m:
+                        if int(m.group(1)) == pid:
+                            current = [None, -1]
+                        continue
+                    if current is None:
+                        continue
+                    m = MEMORY_CONTEXTS_LINE.search(line)
+                    if m:
+                        total = int(m.group(2))
+                        if total > current[1]:
+                            current[0] = m.group(1).split(':', 1)[0]
+                            current[1] = total
+                        continue
+                    m = MEMORY_CONTEXTS_TOTAL.search(line)
+                    if m:
+                        contexts[pid] = (int(m.group(2)) / 1024, current[0])
+                        # the rest of the chunk is of no other backend
+                        # of ours, which are not signalled yet
+                        buf = ''
+                        break
+    finally:
+        os.close(fd)
+    return contexts
+
+
+# attach the pg_stat_activity details to the matching processes
+# a pid only matches if the backend_start of the row agrees with the
+# start time of the process taken from /proc/PID/stat, so a pid that was
+# reused between the /proc scan and the pg_stat_activity snapshot does not
+# get somebody else's query
+# the memory context summaries of get_postgres_activity are attached in
+# the same way
+def match_postgres_activity(pinfos, activity, boot_time, contexts=None):
+    for pid, pinfo in pinfos.items():
+        row = activity.get(pid)
+        if row is None:
+            continue
+        backend_start, qry_state, qry_waiting, query = row
+        if backend_start is not None:
+            started = boot_time + pinfo.starttime / float(USER_HZ)
+            if abs(started - backend_start) > BACKEND_START_SLACK:
+                continue
+        if contexts and pid in contexts:
+            pinfo.mem_contexts = contexts[pid]
+        if query:
+            pinfo.qry_state = qry_state
+            pinfo.waiting_state = qry_waiting
+            pinfo.query = query
 
 
 # utility to return info for given pid (int)
 # will return None if process doesn't exist anymore
-# otherwise a hash:
+# otherwise a ProcessInfo with:
 # "pid" -> int(pid)
 # "uid" -> int(uid)
 # "gid" -> int(gid)
@@ -274,140 +1216,528 @@ def get_postgres_query(pid):
 # "utime" -> int(ticks (0.01 secs) spent in user)
 # "stime" -> int(ticks spent in kernel)
 # "cpu" -> int(last cpu which executed code for this process)
-# "status_mem" -> hash of additional fields
-def get_process_info(pid, kernel_boot_ticks=0, uid=None):
+# "starttime" -> int(ticks after boot when the process was started)
+# "ppid" -> int(pid of the parent)
+# "exists_for" -> int(ticks since the process was started)
+# "smaps" -> hash of smaps_rollup fields (only when smaps is true)
+# "status_mem" -> tuple of additional fields (see STATUS_MEM_COLUMNS)
+def get_process_info(pid, kernel_boot_ticks=0, uid=None, smaps=False,
+                     cache=None, status=True):
     global PAGE_SIZE
 
     page_conv = PAGE_SIZE / 1024
     ret = None
 
     try:
-        pinfo = {}
+        pinfo = ProcessInfo()
 
         # get process owner and group owner using stat
-        stats = os.stat("/proc/%d" % pid)
+        stats = os.stat("%s/%d" % (PROC_ROOT, pid))
+        pinfo.uid = stats.st_uid
+        pinfo.gid = stats.st_gid
 
         if uid is not None:
-            if uid != stats.st_uid:
+            if uid != pinfo.uid:
                 return None
-        pinfo["uid"] = stats.st_uid
-        pinfo["gid"] = stats.st_gid
 
-        pmem = parse_number_file("/proc/%d/statm" % pid)
+        pmem = read_proc_file("%s/%d/statm" % (PROC_ROOT, pid)).split(None, 3)
         # size: total (VMSIZE)
         # resident: rss (total RES)
         # share: shared pages (SHARED)
         # we don't need the other entries
-        del pmem[3:]
-        pmem = map(lambda x: x * page_conv, pmem)
+        pmem = [int(pmem[0]) * page_conv, int(pmem[1]) * page_conv,
+                int(pmem[2]) * page_conv]
 
         # we ignore processes which seem to have zero vmsize (kernel threads)
         if pmem[0] == 0:
             return None
-        pinfo["vmsize"] = pmem[0]
-        pinfo["res"] = pmem[1]
-        pinfo["shared"] = pmem[2]
-        pinfo["ures"] = pmem[1] - pmem[2]
+        pinfo.vmsize = pmem[0]
+        pinfo.res = pmem[1]
+        pinfo.shared = pmem[2]
+        pinfo.ures = pmem[1] - pmem[2]
 
         # get status (this changes between kernel releases)
-        psmem = get_process_mem_from_status(pid)
-        pinfo["status_mem"] = psmem
-
-        pstat = parse_delim_file("/proc/%d/stat" % pid)
-        pcmd = parse_file("/proc/%d/cmdline" % pid)
-        # 1: filename of the executable in parentheses
-        # 2: state
-        # 9: minflt %lu: minor faults (completed without disk access)
-        # 11: majflt %lu: major faults
-
-        pinfo["cmd"] = pcmd
-        pinfo["state"] = pstat[2]
-        pinfo["minflt"] = int(pstat[9])
-        pinfo["majflt"] = int(pstat[11])
-        pinfo["utime"] = int(pstat[13])
-        pinfo["stime"] = int(pstat[14])
-        pinfo["cpu"] = int(pstat[38])
-        pinfo["exists_for"] = kernel_boot_ticks - int(pstat[21])
-        # 13 = usertime (jiff)
-        # 14 = kernel time (jiff)
-        # 21 = start time (jiff)
-        # 38 = last CPU
+        # the sampling modes do not show it and skip it
+        if status:
+            psmem = get_process_mem_from_status(pid)
+            if psmem is not None:
+                pinfo.status_mem = tuple(psmem.get(label)
+                                         for label in STATUS_MEM_COLUMNS)
+
+        if smaps:
+            pinfo.smaps = get_process_mem_from_smaps_rollup(pid)
+
+        # stat has the start time the cache is keyed on
+        pcomm, pstat = parse_stat_file("%s/%d/stat" % (PROC_ROOT, pid))
+        pcmd = None
+        if cache is not None:
+            pcmd = cache.get((pid, int(pstat[19])), pcomm)
+        if pcmd is None:
+            pcmd = parse_file("%s/%d/cmdline" % (PROC_ROOT, pid))
+            if cache is not None:
+                cache.add((pid, int(pstat[19])), pcomm, pcmd)
+        # the field list starts after the command name, so these are
+        # two less than the field numbers of proc(5) (counted from 0)
+        # 0: state
+        # 1: ppid
+        # 7: minflt %lu: minor faults (completed without disk access)
+        # 9: majflt %lu: major faults
+
+        pinfo.cmd = pcmd
+        pinfo.state = pstat[0]
+        pinfo.minflt = int(pstat[7])
+        pinfo.majflt = int(pstat[9])
+        pinfo.utime = int(pstat[11])
+        pinfo.stime = int(pstat[12])
+        pinfo.cpu = int(pstat[36])
+        pinfo.starttime = int(pstat[19])
+        pinfo.exists_for = kernel_boot_ticks - pinfo.starttime
+        # 11 = usertime (jiff)
+        # 12 = kernel time (jiff)
+        # 17 = number of threads
+        # 19 = start time (jiff)
+        # 36 = last CPU
         # hah. these aren't actually in jiffies, but in USER_HZ
         # which has been defined as 100 always
 
-        pinfo["pid"] = pid
-        pinfo["ppid"] = int(pstat[3])
-
-        # attempt to count the number of threads
-        # note than on older linuxen there is no /proc/X/task/
-        thread_count = 0
-        try:
-            if os.access("/proc/%d/task/" % pid, os.X_OK):
-                thread_count = len(os.listdir("/proc/%d/task" % pid))
-        except Exception:
-            pass
-        pinfo["threads"] = thread_count
+        pinfo.pid = pid
+        pinfo.ppid = int(pstat[1])
 
-        try:
-            # Get the Postgresql query details, if any
-            qry_state, qry_waiting, query = get_postgres_query(pid)
-            if query:
-                pinfo['qry_state'] = qry_state
-                pinfo['waiting_state'] = qry_waiting
-                pinfo['query'] = query
-        except:
-            pass
+        # the number of threads, including the main thread, is in stat
+        # since 2.6, so there is no need to list /proc/X/task/
+        pinfo.threads = int(pstat[17])
 
         ret = pinfo
 
+    except (IOError, OSError) as err:
+        # the process has gone away while it was read
+        if err.errno in (errno.ENOENT, errno.ESRCH):
+            profile_count('vanished')
     except Exception:
         pass
 
     return ret
 
 
-# utility to return process information (for all processes)
-# this is basically where most of the work starts from
-def get_process_infos():
-    # this will be the return structure
-    # the key will be the pid
-    pinfos = {}
-    args = cli()
-
-    filter_process_by_uid = None
-    if args.user:
-        try:
-            filter_process_by_uid = pwd.getpwnam(args.user).pw_uid
-        except KeyError:
-            print '[ERROR] User does not exist.'
-            sys.exit(1)
-
-    # start by getting kernel uptime
-    kernel_uptime, kernel_idle_time = parse_delim_file("/proc/uptime")
-    kernel_uptime = int(float(kernel_uptime) * 100)
-
+# utility to list the pids of all processes
+def get_pids():
+    pids = []
     # we need to iterate over the names under /proc at first
-    for n in os.listdir("/proc"):
+    for n in os.listdir(PROC_ROOT):
         # we shortcut the process by attempting a PID conversion first
         # and statting only after that
         # (based on the fact that the only entries in /proc which are
         # integers are the process entries). so we don't do extra
         # open/read/closes on proc when not necessary
         try:
-            pid = int(n)
+            pids.append(int(n))
         except Exception:
             continue
+    return pids
+
+
+# utility to read the pid of the postmaster of a data directory.
+# the first line of postmaster.pid is the pid, the file is only there
+# while the cluster is running.
+def get_postmaster_pid(pgdata):
+    try:
+        return int(parse_delim_file(os.path.join(pgdata, "postmaster.pid"))[0])
+    except (IOError, OSError, IndexError, ValueError):
+        print '[ERROR] Could not read the postmaster pid from ' + os.path.join(pgdata, "postmaster.pid")
+        sys.exit(1)
 
-        # at this point we know that n is a number
+
+# utility to list the direct children of a process using
+# /proc/PID/task/TID/children (Linux 3.5+ with CONFIG_PROC_CHILDREN).
+# children are listed per thread, so every task of the process is read.
+# returns None if the kernel does not provide the children files.
+def get_child_pids(pid):
+    children = []
+    try:
+        for tid in os.listdir("%s/%d/task" % (PROC_ROOT, pid)):
+            children.extend(map(int, parse_delim_file(
+                "%s/%d/task/%s/children" % (PROC_ROOT, pid, tid))))
+    except (IOError, OSError):
+        if os.path.exists("%s/%d" % (PROC_ROOT, pid)):
+            return None
+        # the process is gone, so it has no children
+    return children
+
+
+# utility to list the pids of a process and all of its descendants
+# (the postmaster, its backends and auxiliary processes and anything
+# they started, like archive_command). the tree is walked with the
+# children files, so only the processes of the tree are looked at.
+# if those are not available we fall back to reading the ppid of every
+# process on the host from /proc/PID/stat.
+def get_tree_pids(root_pid):
+    pids = [root_pid]
+    todo = [root_pid]
+    while todo:
+        children = get_child_pids(todo.pop())
+        if children is None:
+            return get_tree_pids_by_ppid(root_pid)
+        pids.extend(children)
+        todo.extend(children)
+    return pids
+
+
+# fallback of get_tree_pids for kernels without the children files
+def get_tree_pids_by_ppid(root_pid):
+    children = {}
+    for pid in get_pids():
+        try:
+            ppid = int(parse_stat_file("%s/%d/stat" % (PROC_ROOT, pid))[1][1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(pid)
+    pids = [root_pid]
+    todo = [root_pid]
+    while todo:
+        kids = children.get(todo.pop(), [])
+        pids.extend(kids)
+        todo.extend(kids)
+    return pids
+
+
+# utility to return process information for a list of pids
+# the key of the returned hash will be the pid
+def scan_pids(pids, kernel_uptime, uid=None, smaps=False, cache=None,
+              status=True):
+    pinfos = {}
+    for pid in pids:
         # note that it might be so that the process doesn't exist anymore
         # this is why we just ignore it if it has gone AWOL.
-        pinfo = get_process_info(pid, kernel_uptime, filter_process_by_uid)
+        pinfo = get_process_info(pid, kernel_uptime, uid, smaps, cache, status)
         if pinfo is not None:
             pinfos[pid] = pinfo
+    return pinfos
+
+
+# worker for scan_pids_parallel, needs to be a module level function
+# so that it can be sent to a process pool.
+# also returns the smaps_rollup cost and the "--profile" counters of the
+# chunk, which would otherwise be lost in the worker process
+def scan_pids_chunk(chunk_args):
+    pids, kernel_uptime, uid, smaps, cache, status = chunk_args
+    reads, secs, denied = SMAPS_ROLLUP_COST
+    counters = None
+    if PROFILE is not None:
+        counters = dict(PROFILE.counters)
+    pinfos = scan_pids(pids, kernel_uptime, uid, smaps, cache, status)
+    if counters is not None:
+        counters = dict((k, v - counters[k]) for k, v in PROFILE.counters.iteritems())
+    return pinfos, (SMAPS_ROLLUP_COST[0] - reads, SMAPS_ROLLUP_COST[1] - secs,
+                    SMAPS_ROLLUP_COST[2] - denied), counters
+
+
+# utility to split the scan of a list of pids across a pool of workers
+# pids are dealt out round-robin, as neighbouring pids often belong to the
+# same kind of process (eg. a burst of connections), which would make
+# contiguous chunks uneven.
+# the cache can only be shared with threads, process workers go without.
+def scan_pids_parallel(pids, kernel_uptime, uid=None, smaps=False, jobs=2,
+                       pool_type='thread', cache=None, status=True):
+    jobs = min(jobs, len(pids))
+    if pool_type == 'process':
+        cache = None
+    chunks = [(pids[i::jobs], kernel_uptime, uid, smaps, cache, status)
+              for i in range(jobs)]
+    if pool_type == 'process':
+        pool = multiprocessing.Pool(jobs)
+    else:
+        pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+        results = pool.map(scan_pids_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    pinfos = {}
+    for chunk_pinfos, cost, counters in results:
+        pinfos.update(chunk_pinfos)
+        # threads already added their cost to our SMAPS_ROLLUP_COST
+        if pool_type == 'process':
+            SMAPS_ROLLUP_COST[0] += cost[0]
+            SMAPS_ROLLUP_COST[1] += cost[1]
+            SMAPS_ROLLUP_COST[2] += cost[2]
+            if counters is not None:
+                for counter, value in counters.iteritems():
+                    PROFILE.count(counter, value)
+    return pinfos
+
+
+# utility to return the uid given with "-u", or None
+def get_filter_uid(args):
+    if not args.user:
+        return None
+    try:
+        return pwd.getpwnam(args.user).pw_uid
+    except KeyError:
+        print '[ERROR] User does not exist.'
+        sys.exit(1)
+
+
+# utility to list the pids to look at: the postmaster tree with "-D" or
+# "-P", otherwise every process
+def discover_pids(args):
+    if args.pgdata:
+        return get_tree_pids(get_postmaster_pid(args.pgdata))
+    elif args.postmaster_pid:
+        return get_tree_pids(args.postmaster_pid)
+    return get_pids()
+
+
+# light-weight scan used by "--watch"
+# only /proc/PID/stat (for the start time) and /proc/PID/statm are read.
+# returns a hash of (pid, starttime) -> URES in kilobytes
+def get_ures_samples(pids, uid=None):
+    page_conv = PAGE_SIZE / 1024
+    samples = {}
+    for pid in pids:
+        try:
+            if uid is not None and os.stat("%s/%d" % (PROC_ROOT, pid)).st_uid != uid:
+                continue
+            pmem = read_proc_file("%s/%d/statm" % (PROC_ROOT, pid)).split(None, 3)
+            if pmem[0] == '0':
+                continue
+            starttime = int(parse_stat_file("%s/%d/stat" % (PROC_ROOT, pid))[1][19])
+        except (IOError, OSError, IndexError):
+            # the process has gone away
+            continue
+        samples[(pid, starttime)] = (int(pmem[1]) - int(pmem[2])) * page_conv
+    return samples
+
+
+# first phase of the two-phase collection used with "-n"
+# only /proc/PID/statm is read (and /proc/PID stat'ed when filtering
+# by uid), which is enough to rank the processes by URES.
+# returns the pids of the n processes with the most URES, biggest first,
+# and the URES sum of all of the processes.
+def rank_pids_by_ures(pids, n, uid=None):
+    page_conv = PAGE_SIZE / 1024
+    ures_sum = 0
+    ranked = []
+    for pid in pids:
+        try:
+            if uid is not None and os.stat("%s/%d" % (PROC_ROOT, pid)).st_uid != uid:
+                continue
+            pmem = read_proc_file("%s/%d/statm" % (PROC_ROOT, pid)).split(None, 3)
+        except (IOError, OSError):
+            # the process has gone away
+            profile_count('vanished')
+            continue
+        # we ignore processes which seem to have zero vmsize (kernel threads)
+        if pmem[0] == '0':
+            continue
+        ures = (int(pmem[1]) - int(pmem[2])) * page_conv
+        ures_sum += ures
+        ranked.append((ures, pid))
+    return [pid for ures, pid in heapq.nlargest(n, ranked)], ures_sum
+
+
+# utility to return process information (for all processes)
+# this is basically where most of the work starts from, and what to use
+# to embed the collection: args are the parsed arguments or a
+# CollectOptions (the defaults if not given), /proc is read from
+# PROC_ROOT (see set_proc_root).
+# returns a hash of pid -> ProcessInfo
+# when pids is given, only those processes are looked at
+# repeated scans can pass a ProcessCache, and skip /proc/PID/status
+# with status=False when its fields are not shown
+def get_process_infos(args=None, pids=None, cache=None, status=True):
+    if args is None:
+        args = CollectOptions()
+
+    filter_process_by_uid = get_filter_uid(args)
+
+    # start by getting kernel uptime
+    kernel_uptime, kernel_idle_time = parse_delim_file(PROC_ROOT + "/uptime")
+    kernel_uptime = int(float(kernel_uptime) * 100)
+
+    full_scan = pids is None
+    if full_scan:
+        mark = profile_begin()
+        pids = discover_pids(args)
+        profile_end('discovery', mark)
+    mark = profile_begin()
+    if args.jobs > 1 and len(pids) > 1:
+        pinfos = scan_pids_parallel(pids, kernel_uptime, filter_process_by_uid,
+                                    args.pss, args.jobs, args.pool, cache, status)
+    else:
+        pinfos = scan_pids(pids, kernel_uptime, filter_process_by_uid, args.pss,
+                           cache, status)
+    profile_end('parsing', mark)
+    # only a scan of every process tells which ones are gone
+    if cache is not None and full_scan:
+        cache.evict()
+
+    # one pg_stat_activity snapshot for all of the processes, taken
+    # right after the /proc scan
+    if args.all_clusters:
+        assign_clusters(pinfos)
+
+    if args.postgres_query or args.memory_contexts:
+        log_pids = None
+        if args.memory_contexts:
+            top = MEMORY_CONTEXTS_TOP
+            if args.lines_of_output and int(args.lines_of_output) > 0:
+                top = int(args.lines_of_output)
+            backends = [p for p in pinfos.itervalues()
+                        if get_backend_type(p) not in ('other', 'postmaster')]
+            log_pids = [p.pid for p in heapq.nlargest(top, backends,
+                                                      key=lambda p: p.ures)]
+        mark = profile_begin()
+        attach_postgres_queries(pinfos, kernel_uptime, log_pids, args)
+        profile_end('postgres', mark)
 
     return pinfos
 
 
+# utility to take one pg_stat_activity snapshot and attach the queries
+# to the processes (see match_postgres_activity)
+# with log_pids the memory contexts of those backends are logged and
+# attached as well, over the same connection
+# with "--all-clusters" every cluster is queried, concurrently
+# an error of the database ends the run, unless fatal is false, then it
+# is only warned about
+def attach_postgres_queries(pinfos, kernel_uptime, log_pids=None, args=None,
+                            fatal=True):
+    try:
+        import psycopg2
+    except ImportError:
+        print >> sys.stderr, '[WARNING] psycopg2 is required to retrieve the queries.'
+        return
+    boot_time = time.time() - kernel_uptime / float(USER_HZ)
+
+    if args is None or not args.all_clusters:
+        dsn = None
+        if args is not None:
+            dsn = get_postgres_dsn(args.pg_dbname, args.pg_user, args.pg_host, args.pg_port)
+        try:
+            activity, contexts = get_postgres_activity(log_pids, dsn)
+        except psycopg2.DatabaseError, e:
+            if not fatal:
+                print >> sys.stderr, '[WARNING] %s' % e
+                return
+            print 'Error %s' % e
+            sys.exit(1)
+        match_postgres_activity(pinfos, activity, boot_time, contexts)
+        return
+
+    clusters = {}
+    for pinfo in pinfos.itervalues():
+        cluster = pinfo.cluster_info
+        if cluster is not None:
+            clusters[cluster["datadir"]] = cluster
+    if not clusters:
+        return
+    log_pids = set(log_pids or [])
+
+    def fetch(cluster):
+        dsn = get_postgres_dsn(args.pg_dbname, args.pg_user,
+                               args.pg_host or cluster["socket"],
+                               args.pg_port or cluster["port"])
+        cluster_log_pids = [p for p in log_pids
+                            if pinfos[p].cluster == cluster["datadir"]]
+        try:
+            return get_postgres_activity(cluster_log_pids, dsn)
+        except psycopg2.DatabaseError, e:
+            print >> sys.stderr, '[WARNING] Cluster %s: %s' % (cluster["datadir"], e)
+            return {}, {}
+
+    pool = multiprocessing.pool.ThreadPool(len(clusters))
+    try:
+        results = pool.map(fetch, clusters.values())
+    finally:
+        pool.close()
+        pool.join()
+    # pids are unique on the host, so the snapshots can be merged
+    activity = {}
+    contexts = {}
+    for cluster_activity, cluster_contexts in results:
+        activity.update(cluster_activity)
+        contexts.update(cluster_contexts)
+    match_postgres_activity(pinfos, activity, boot_time, contexts)
+
+
+# the clusters found so far, by postmaster pid
+CLUSTERS = {}
+
+
+# utility to return the data directory, port and socket directory of the
+# cluster of a postmaster, from the postmaster.pid in its data directory
+# (the working directory of the postmaster). returns None if that cannot
+# be read.
+def get_cluster_info(postmaster_pid):
+    cluster = CLUSTERS.get(postmaster_pid)
+    if cluster is not None:
+        return cluster
+    try:
+        datadir = os.readlink("%s/%d/cwd" % (PROC_ROOT, postmaster_pid))
+        lines = read_proc_file(os.path.join(datadir, "postmaster.pid")).split('\n')
+        if int(lines[0]) != postmaster_pid:
+            return None
+    except (IOError, OSError, ValueError):
+        return None
+    cluster = {"pid": postmaster_pid, "datadir": datadir, "port": None, "socket": None}
+    # line 4 is the port and line 5 the socket directory (9.1+)
+    if len(lines) > 3 and lines[3].strip().isdigit():
+        cluster["port"] = int(lines[3])
+    if len(lines) > 4 and lines[4].strip():
+        cluster["socket"] = lines[4].strip()
+    CLUSTERS[postmaster_pid] = cluster
+    return cluster
+
+
+# utility to assign the processes to the cluster of the postmaster they
+# descend from, by following the ppid. processes that are not in pinfos
+# (eg. a postmaster owned by another user) are looked up in /proc.
+# sets "cluster" (the data directory, or "postmaster PID" if that cannot
+# be read) and "cluster_info" (see get_cluster_info) of every process of
+# a cluster.
+def assign_clusters(pinfos):
+    # pid -> postmaster pid, or None if the process is not part of a cluster
+    roots = {1: None, 0: None}
+
+    def get_parent(pid):
+        pinfo = pinfos.get(pid)
+        if pinfo is not None:
+            return pinfo.ppid, pinfo.cmd
+        try:
+            ppid = int(parse_stat_file("%s/%d/stat" % (PROC_ROOT, pid))[1][1])
+            cmd = parse_file("%s/%d/cmdline" % (PROC_ROOT, pid))
+        except (IOError, OSError, IndexError, ValueError):
+            return 0, ''
+        return ppid, cmd
+
+    for pid in pinfos:
+        path = []
+        current = pid
+        while current not in roots:
+            path.append(current)
+            ppid, cmd = get_parent(current)
+            if classify_process(cmd)[0] == 'postmaster':
+                roots[current] = current
+                path.pop()
+                break
+            current = ppid
+        root = roots[current]
+        for p in path:
+            roots[p] = root
+
+    for pid, pinfo in pinfos.iteritems():
+        root = roots.get(pid)
+        if root is None:
+            continue
+        cluster = get_cluster_info(root)
+        pinfo.cluster_info = cluster
+        if cluster is not None:
+            pinfo.cluster = cluster["datadir"]
+        else:
+            pinfo.cluster = "postmaster %d" % root
+
+
 # utility to return human readable time
 # three return formats:
 # < hour: x:%.2y
@@ -431,7 +1761,9 @@ def get_time(ticks):
 # ticks is understood to mean "for" (when something was started X ticks ago)
 # the label is "started", so an absolute timestamp would be nice
 # if difference to current clock is more than one day, we display the date
-def get_elapsed(ticks, now=time.time()):
+def get_elapsed(ticks, now=None):
+    if now is None:
+        now = time.time()
     ticks /= 100  # conv to seconds
     if ticks < 60 * 60 * 24:
         return time.strftime("%H:%M:%S", time.localtime(now - ticks))
@@ -446,47 +1778,209 @@ def get_elapsed(ticks, now=time.time()):
 #
 # stat_map:
 # ordered list of field-names that we want to output
-def get_process_row(pinfo, stat_map, with_cpu=0, args=None, get_current_time=False):
+def get_process_row(pinfo, stat_map, with_cpu=0, args=None, get_current_time=False, now=None):
     # PID UID URES SHR VIRT MINFLT MAJFLT S CMD"
-    username = NAME_CACHE.get_uid(pinfo["uid"])
+    username = NAME_CACHE.get_uid(pinfo.uid)
 
     currentTime = []
     if get_current_time:
-        currentTime = [time.time()]
+        if now is None:
+            now = time.time()
+        currentTime = [now]
     cpu = None
     if with_cpu:
-        cpu = pinfo["cpu"]
+        cpu = pinfo.cpu
 
     mainInfo = [
-        pinfo["pid"],
+        pinfo.pid,
         username,
-        pinfo["ures"],
-        pinfo["shared"],
-        pinfo["vmsize"]]
-    restInfo = [pinfo["minflt"],
-                pinfo["majflt"],
+        pinfo.ures,
+        pinfo.shared,
+        pinfo.vmsize]
+    if args is not None and args.pss:
+        smaps = pinfo.smaps or {}
+        mainInfo.append(smaps.get("PSS", ""))
+        mainInfo.append(smaps.get("USS", ""))
+        for dummy, label in SMAPS_ROLLUP_MAP[1:]:
+            mainInfo.append(smaps.get(label, ""))
+    restInfo = [pinfo.minflt,
+                pinfo.majflt,
                 cpu,
-                pinfo["threads"],
-                get_elapsed(pinfo["exists_for"]),
-                pinfo["state"],
-                pinfo["cmd"]]
+                pinfo.threads,
+                get_elapsed(pinfo.exists_for),
+                pinfo.state,
+                pinfo.cmd]
 
     queryInfo = []
+    if args.memory_contexts:
+        ctx_used, ctx_top = pinfo.mem_contexts or ('', '')
+        if pinfo.mem_contexts is not None and ctx_used is None:
+            # logged, but the log could not be read
+            ctx_used, ctx_top = 'logged', ''
+        queryInfo = [ctx_used, ctx_top]
     if args.postgres_query:
-        queryInfo = [pinfo.get('qry_state',''), pinfo.get('waiting_state',''), pinfo.get('query','')]
+        queryInfo += [pinfo.qry_state or '', pinfo.waiting_state or '', pinfo.query or '']
 
     # generate the status_mem entries
-    status_mem = pinfo["status_mem"]
     status_mem_entries = []
     for label in stat_map:
-        if label in status_mem:
-            status_mem_entries.append(status_mem[label])
+        value = pinfo.status(label)
+        if value is not None:
+            status_mem_entries.append(value)
         else:
             status_mem_entries.append("")
 
     return currentTime + mainInfo + status_mem_entries + restInfo + queryInfo
 
 
+# utility to classify a process from its command line
+# returns a tuple of (backend type, user@database) where the second
+# entry is only set for client backends. processes that are not part of
+# a postgres cluster are of type "other", the postmaster itself (which
+# keeps its original command line) is "postmaster".
+def classify_process(cmd):
+    if not cmd.startswith('postgres: '):
+        program = os.path.basename(cmd.split(' ', 1)[0])
+        if program in ('postgres', 'postmaster'):
+            return 'postmaster', None
+        return 'other', None
+    title = cmd[10:]
+    # with cluster_name set the title is "postgres: name: ..."
+    space = title.find(' ')
+    colon = title.find(': ')
+    if colon != -1 and (space == -1 or colon < space):
+        title = title[colon + 2:]
+    for prefix, backend_type in PG_BACKEND_TYPES:
+        if title.startswith(prefix) and title[len(prefix):len(prefix) + 1] in ('', ' '):
+            return backend_type, None
+    words = title.split(' ', 2)
+    if len(words) < 2:
+        return 'client backend', None
+    return 'client backend', words[0] + '@' + words[1]
+
+
+# utility to return the backend type of a process (see classify_process)
+# the result is kept in the process info
+def get_backend_type(pinfo):
+    if pinfo.backend_type is None:
+        pinfo.backend_type, pinfo.backend_db = classify_process(pinfo.cmd)
+    return pinfo.backend_type
+
+
+# utility to group the processes for the aggregate reports
+# all of the requested reports are built in one pass over pinfos.
+# returns a hash of report name -> hash of group -> list of:
+# [count, memory sum, memory of the top consumer, pid of the top consumer,
+#  minor faults sum, major faults sum]
+# memory is URES, or PSS with --pss. the query report groups the backends
+# by the fingerprint of their query (see normalize_query).
+def get_aggregates(pinfos, reports, pss=False):
+    aggregates = dict((report, {}) for report in reports)
+    by_user = aggregates.get('user')
+    by_program = aggregates.get('program')
+    by_cpu = aggregates.get('cpu')
+    by_type = aggregates.get('type')
+    by_database = aggregates.get('database')
+    by_cluster = aggregates.get('cluster')
+    by_query = aggregates.get('query')
+    if by_cluster is not None and pinfos and \
+            all(p.cluster is None for p in pinfos.itervalues()):
+        assign_clusters(pinfos)
+
+    for pid, pinfo in pinfos.iteritems():
+        if pss:
+            mem = (pinfo.smaps or {}).get("PSS", 0)
+        else:
+            mem = pinfo.ures
+        keys = []
+        if by_user is not None:
+            keys.append((by_user, NAME_CACHE.get_uid(pinfo.uid)))
+        if by_program is not None:
+            program = pinfo.cmd.split(' ', 1)[0]
+            keys.append((by_program, os.path.basename(program).rstrip(':')))
+        if by_cpu is not None:
+            keys.append((by_cpu, pinfo.cpu))
+        if by_type is not None or by_database is not None:
+            backend_type = get_backend_type(pinfo)
+            if by_type is not None:
+                keys.append((by_type, backend_type))
+            if by_database is not None and pinfo.backend_db is not None:
+                keys.append((by_database, pinfo.backend_db))
+        if by_cluster is not None and pinfo.cluster is not None:
+            keys.append((by_cluster, pinfo.cluster))
+        if by_query is not None and pinfo.query:
+            keys.append((by_query, FINGERPRINT_CACHE.get(pinfo.query)))
+        for groups, key in keys:
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [1, mem, mem, pid, pinfo.minflt, pinfo.majflt]
+                continue
+            group[0] += 1
+            group[1] += mem
+            group[4] += pinfo.minflt
+            group[5] += pinfo.majflt
+            if mem > group[2]:
+                group[2] = mem
+                group[3] = pid
+    return aggregates
+
+
+# utility to output the aggregate reports, biggest groups first
+def output_aggregates(aggregates, reports, args, out=sys.stdout, write_header=True):
+    mem_header = "URES"
+    if args.pss:
+        mem_header = "PSS"
+    header = ["COUNT", mem_header, "AVG", "TOP", "TOP-PID", "MINFLT", "MAJFLT"]
+    if structured_output(args):
+        writer = RowWriter(out, ["report", "group"] + header,
+                           args.json_output, write_header)
+    for report in reports:
+        groups = aggregates[report].items()
+        groups.sort(key=lambda x: x[1][1], reverse=True)
+        if structured_output(args):
+            for key, group in groups:
+                writer.write_row([report, key, group[0], group[1],
+                                  group[1] / group[0], group[2], group[3],
+                                  group[4], group[5]])
+            continue
+        print_label("Processes by " + report)
+        table = JustifiedTable()
+        table.add_row([report.upper()] + header)
+        for key, group in groups:
+            table.add_row([key, group[0], group[1], group[1] / group[0],
+                           group[2], group[3], group[4], group[5]])
+        table.output(None)
+
+
+# utility to tell if the output is CSV or JSON Lines rather than a table
+def structured_output(args):
+    return args.csv_output is not None or args.json_output
+
+
+# utility to open the output once for the whole run
+# returns the handle and whether a header needs to be written
+# (not when appending to a file that already has content)
+def open_output(args):
+    if args.output_file == 'stdout':
+        return sys.stdout, True
+    try:
+        if args.append:
+            out = open(args.output_file, 'ab', OUTPUT_BUFFER_SIZE)
+            return out, os.fstat(out.fileno()).st_size == 0
+        return open(args.output_file, 'wb', OUTPUT_BUFFER_SIZE), True
+    except IOError as err:
+        print 'Attempted to write to ' + args.output_file + '. Error: ' + err.strerror
+        sys.exit(1)
+
+
+# utility to close what open_output opened
+def close_output(out):
+    if out is sys.stdout:
+        out.flush()
+    else:
+        out.close()
+
+
 # utility to print a label:
 # - print empty line
 # - print text
@@ -497,51 +1991,1898 @@ def print_label(s):
     print '-' * len(s)
 
 
+# utility to compute the per-process change between two samples
+# processes are matched on (pid, starttime), so a pid that has been reused
+# by a new process between the samples is reported as new instead of
+# producing a bogus delta.
+# returns a list of hashes:
+# "pinfo" -> the ProcessInfo of the current sample
+# "new" -> bool(process was not present in the previous sample)
+# "ures_delta" -> int(URES growth in kilobytes)
+# "ures_rate" -> float(URES growth in kilobytes per second)
+# "minflt_rate" -> float(minor faults per second)
+# "majflt_rate" -> float(major faults per second)
+# "utime_pct" -> float(percent of one cpu spent in user)
+# "stime_pct" -> float(percent of one cpu spent in kernel)
+def get_process_rates(prev_pinfos, pinfos, elapsed):
+    prev_by_key = {}
+    for pinfo in prev_pinfos.values():
+        prev_by_key[(pinfo.pid, pinfo.starttime)] = pinfo
+
+    if elapsed <= 0:
+        elapsed = 1e-6
+    tick_pct = 100.0 / USER_HZ / elapsed
+    # the baseline of the processes that started within the interval
+    started = ProcessInfo()
+    started.ures = started.minflt = started.majflt = 0
+    started.utime = started.stime = 0
+
+    rates = []
+    for pinfo in pinfos.values():
+        prev = prev_by_key.get((pinfo.pid, pinfo.starttime))
+        rate = {"pinfo": pinfo, "new": prev is None}
+        if prev is None:
+            # compare against nothing, the process started within the
+            # interval (or at least after the previous sample)
+            prev = started
+            age = pinfo.exists_for / float(USER_HZ)
+            if 0 < age < elapsed:
+                span = age
+            else:
+                span = elapsed
+        else:
+            span = elapsed
+        rate["ures_delta"] = pinfo.ures - prev.ures
+        rate["ures_rate"] = rate["ures_delta"] / span
+        rate["minflt_rate"] = (pinfo.minflt - prev.minflt) / span
+        rate["majflt_rate"] = (pinfo.majflt - prev.majflt) / span
+        rate["utime_pct"] = (pinfo.utime - prev.utime) * tick_pct
+        rate["stime_pct"] = (pinfo.stime - prev.stime) * tick_pct
+        rates.append(rate)
+    return rates
+
+
+# utility to get the rates of a process as a row suitable into tabling
+def get_rate_row(rate, get_current_time=None):
+    pinfo = rate["pinfo"]
+    currentTime = []
+    if get_current_time is not None:
+        currentTime = [get_current_time]
+    started = get_elapsed(pinfo.exists_for)
+    if rate["new"]:
+        started += "*"
+    return currentTime + [
+        pinfo.pid,
+        NAME_CACHE.get_uid(pinfo.uid),
+        pinfo.ures,
+        rate["ures_delta"],
+        round(rate["ures_rate"], 1),
+        round(rate["minflt_rate"], 1),
+        round(rate["majflt_rate"], 1),
+        round(rate["utime_pct"], 1),
+        round(rate["stime_pct"], 1),
+        started,
+        pinfo.state,
+        pinfo.cmd]
+
+
+# continuous sampling mode
+# the first sample only sets the baseline, every following one reports
+# the changes since the previous sample. rows are sorted by URES growth.
+# processes that were not in the previous sample have nothing to compare
+# against and are left out of the rows until the next one.
+def run_sampling(args):
+    rate_header = ["PID", "UID", "URES", "dURES", "URES/s", "MINFLT/s",
+                   "MAJFLT/s", "USR%", "SYS%", "started", "S", "CMD"]
+
+    result_rows_limit = None
+    if args.lines_of_output and int(args.lines_of_output) > 0:
+        result_rows_limit = int(args.lines_of_output)
+
+    fout, write_header = open_output(args)
+    writer = None
+    if structured_output(args):
+        if args.sum_only:
+            header = ["epoch_time", "URES_sum", "dURES"]
+        else:
+            header = ["epoch_time"] + rate_header
+        writer = RowWriter(fout, header, args.json_output, write_header)
+
+    cache = ProcessCache()
+    prev_pinfos = get_process_infos(args, cache=cache, status=False)
+    prev_time = time.time()
+    prev_ures_sum = sum(p.ures for p in prev_pinfos.itervalues())
+    record_history(args, prev_pinfos, prev_time)
+    reported = 0
+    try:
+        while args.count is None or reported < args.count:
+            # sleep until the next tick of the interval, so the time spent
+            # collecting does not make the samples drift
+            time.sleep(max(0, prev_time + args.interval - time.time()))
+            pinfos = get_process_infos(args, cache=cache, status=False)
+            now = time.time()
+            record_history(args, pinfos, now)
+            rates = get_process_rates(prev_pinfos, pinfos, now - prev_time)
+            prev_pinfos = pinfos
+            prev_time = now
+            reported += 1
+
+            if args.sum_only:
+                ures_sum = 0
+                for rate in rates:
+                    ures_sum += rate["pinfo"].ures
+                ures_delta = ures_sum - prev_ures_sum
+                prev_ures_sum = ures_sum
+                if writer is not None:
+                    writer.write_row([now, ures_sum, ures_delta])
+                else:
+                    print >> fout, '%s Unique Resident Memory sum: %d Kilobytes (%+d)' % (
+                        time.strftime("%H:%M:%S", time.localtime(now)),
+                        ures_sum, ures_delta)
+                fout.flush()
+                continue
+
+            rates = [rate for rate in rates if not rate["new"]]
+            rates.sort(key=lambda r: (r["ures_delta"], r["pinfo"].ures),
+                       reverse=True)
+            if result_rows_limit:
+                rates = rates[:result_rows_limit]
+
+            if writer is not None:
+                for rate in rates:
+                    writer.write_row(get_rate_row(rate, now))
+            else:
+                print_label(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)))
+                process_table = JustifiedTable()
+                process_table.add_row(rate_header)
+                for rate in rates:
+                    process_table.add_row(get_rate_row(rate))
+                process_table.output(None)
+            fout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_output(fout)
+
+
+# utility class for the history ring buffer
+# the file is memory-mapped and records are packed straight into the map,
+# so appending does not build any intermediate strings.
+# the header keeps the number of records ever written; record n is at
+# slot n % capacity, which makes the slots from there on the oldest ones.
+# only one process is expected to append at a time.
+class HistoryBuffer:
+    def __init__(self, filename, capacity=HISTORY_SIZE, readonly=False):
+        exists = os.path.exists(filename)
+        if readonly:
+            self.f = open(filename, 'rb')
+        elif exists:
+            self.f = open(filename, 'r+b')
+        else:
+            self.f = open(filename, 'w+b')
+            self.f.write(HISTORY_HEADER.pack(HISTORY_MAGIC, 1, HISTORY_RECORD.size, capacity, 0))
+            self.f.truncate(HISTORY_HEADER.size + capacity * HISTORY_RECORD.size)
+            self.f.flush()
+        if readonly:
+            self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = mmap.mmap(self.f.fileno(), 0)
+        if len(self.map) < HISTORY_HEADER.size:
+            self.close()
+            raise ValueError('%s is not a pg_meminfo history file' % filename)
+        magic, version, record_size, self.capacity, self.written = \
+            HISTORY_HEADER.unpack_from(self.map, 0)
+        if magic != HISTORY_MAGIC or record_size != HISTORY_RECORD.size:
+            self.close()
+            raise ValueError('%s is not a pg_meminfo history file' % filename)
+
+    def close(self):
+        self.map.close()
+        self.f.close()
+
+    # append one record per process, all with the same timestamp
+    def append(self, pinfos, now):
+        pack_into = HISTORY_RECORD.pack_into
+        base = HISTORY_HEADER.size
+        size = HISTORY_RECORD.size
+        written = self.written
+        for pinfo in pinfos.itervalues():
+            pack_into(self.map, base + (written % self.capacity) * size,
+                      now, pinfo.pid,
+                      BACKEND_TYPE_INDEX[get_backend_type(pinfo)],
+                      pinfo.starttime, pinfo.ures, pinfo.shared,
+                      pinfo.vmsize, pinfo.minflt, pinfo.majflt,
+                      pinfo.utime, pinfo.stime)
+            written += 1
+        # the records are in place before the header says they are there
+        HISTORY_HEADER.pack_into(self.map, 0, HISTORY_MAGIC, 1, size,
+                                 self.capacity, written)
+        self.written = written
+
+    # utility to read record number n (counting all records ever written)
+    def record(self, n):
+        return HISTORY_RECORD.unpack_from(
+            self.map, HISTORY_HEADER.size + (n % self.capacity) * HISTORY_RECORD.size)
+
+    # iterate over the records, oldest first, optionally only the ones
+    # at or after since. the records are in time order, so the first one
+    # is found with a binary search.
+    def records(self, since=None):
+        first = max(0, self.written - self.capacity)
+        if since is not None:
+            first = bisect.bisect_left(HistoryTimestamps(self), since, first, self.written)
+        for n in xrange(first, self.written):
+            yield self.record(n)
+
+
+# sequence view of the timestamps of a HistoryBuffer, for bisect
+class HistoryTimestamps:
+    def __init__(self, history):
+        self.history = history
+
+    def __getitem__(self, n):
+        return self.history.record(n)[0]
+
+    def __len__(self):
+        return self.history.written
+
+
+# the history files being appended to, kept open (and mapped) for the
+# whole run so that every sample only packs its records
+HISTORY_BUFFERS = {}
+
+
+# utility to append a collection to the "--history" file, if one was given
+def record_history(args, pinfos, now=None):
+    if not args.history_file:
+        return
+    if now is None:
+        now = time.time()
+    history = HISTORY_BUFFERS.get(args.history_file)
+    if history is None:
+        try:
+            history = HistoryBuffer(args.history_file, args.history_size)
+        except (IOError, OSError, ValueError) as err:
+            print >> sys.stderr, '[WARNING] Cannot write the history: %s' % err
+            return
+        HISTORY_BUFFERS[args.history_file] = history
+    history.append(pinfos, now)
+
+
+# report the peak, average and growth of URES from a history file
+# per process (pid and starttime) or, with "-r type", per backend type
+# where the per-type sum of every sample is used.
+def run_history_report(args):
+    try:
+        history = HistoryBuffer(args.history_file, readonly=True)
+    except (IOError, OSError, ValueError) as err:
+        print '[ERROR] Cannot read the history: %s' % err
+        sys.exit(1)
+
+    since = None
+    if args.since is not None:
+        since = time.time() - args.since
+    by_type = bool(args.reports and 'type' in args.reports)
+
+    # key -> [samples, first ts, last ts, first ures, last ures, peak, sum]
+    stats = {}
+    try:
+        if by_type:
+            # sum the processes of each type per sample first
+            sums = {}
+            for record in history.records(since):
+                key = (record[2], record[0])
+                sums[key] = sums.get(key, 0) + record[4]
+            samples = sorted((k[0], k[1], v) for k, v in sums.iteritems())
+        else:
+            samples = (((r[1], r[3]), r[0], r[4]) for r in history.records(since))
+        for key, ts, ures in samples:
+            stat = stats.get(key)
+            if stat is None:
+                stats[key] = [1, ts, ts, ures, ures, ures, ures]
+                continue
+            stat[0] += 1
+            stat[2] = ts
+            stat[4] = ures
+            if ures > stat[5]:
+                stat[5] = ures
+            stat[6] += ures
+    finally:
+        history.close()
+
+    rows = []
+    for key, stat in stats.iteritems():
+        if by_type:
+            ident = [BACKEND_TYPE_CODES[key]]
+        else:
+            ident = [key[0]]
+        rows.append(ident + [stat[0],
+                             time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stat[1])),
+                             time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stat[2])),
+                             stat[5], stat[6] / stat[0], stat[4] - stat[3]])
+    rows.sort(key=lambda r: r[4], reverse=True)
+    if by_type:
+        header = ["TYPE"]
+    else:
+        header = ["PID"]
+    header += ["SAMPLES", "FIRST", "LAST", "PEAK", "AVG", "GROWTH"]
+
+    if structured_output(args):
+        out, write_header = open_output(args)
+        try:
+            writer = RowWriter(out, header, args.json_output, write_header)
+            for row in rows:
+                writer.write_row(row)
+        finally:
+            close_output(out)
+        return
+    table = JustifiedTable()
+    table.add_row(header)
+    for row in rows:
+        table.add_row(row)
+    table.output(None)
+
+
+# utility to read a CSV capture of "-c -o" one process at a time
+# yields tuples of (pid, user, ures, virt, minflt, majflt, started, cmd),
+# repeated headers (from "-a") are skipped. a row with another number of
+# fields than the header ends the run, its columns would be mixed up.
+def read_capture(path):
+    try:
+        f = open(path, 'rb')
+    except IOError as err:
+        print '[ERROR] Cannot read the capture %s: %s' % (path, err.strerror)
+        sys.exit(1)
+    try:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        missing = [c for c in DIFF_COLUMNS if c not in header]
+        if missing:
+            print '[ERROR] %s is not a pg_meminfo CSV capture, it is missing: %s' % (
+                path, ', '.join(missing))
+            sys.exit(1)
+        pos = [header.index(c) for c in DIFF_COLUMNS]
+        for row in reader:
+            if row == header:
+                continue
+            if len(row) != len(header):
+                print '[ERROR] %s line %d has %d fields, the header has %d.' % (
+                    path, reader.line_num, len(row), len(header))
+                sys.exit(1)
+            pid, user, ures, virt, minflt, majflt, started, cmd = [row[i] for i in pos]
+            yield (int(pid), user, int(ures), int(virt), int(minflt), int(majflt),
+                   started, cmd)
+    finally:
+        f.close()
+
+
+# utility to tell if a capture is sorted by PID, without keeping it
+def capture_sorted_by_pid(path):
+    prev = -1
+    for row in read_capture(path):
+        if row[0] < prev:
+            return False
+        prev = row[0]
+    return True
+
+
+# utility to tell if two rows of captures are the same process
+# a pid that has been reused has another start time. the start time is
+# rendered from the uptime at the time of the capture, so it can be off
+# by a second or two.
+def same_capture_process(old, new):
+    if old[0] != new[0]:
+        return False
+    if old[6] == new[6]:
+        return True
+    try:
+        old_started = time.strptime(old[6], "%H:%M:%S")
+        new_started = time.strptime(new[6], "%H:%M:%S")
+    except ValueError:
+        return False
+    diff = abs(time.mktime(old_started) - time.mktime(new_started))
+    return min(diff, 24 * 60 * 60 - diff) <= BACKEND_START_SLACK
+
+
+# utility to pair up the processes of two captures sorted by PID
+# yields (old row, new row), either being None for a process that is
+# only in one of them.
+def merge_captures(old_path, new_path):
+    old_rows = read_capture(old_path)
+    new_rows = read_capture(new_path)
+    old = next(old_rows, None)
+    new = next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield old, None
+            old = next(old_rows, None)
+        elif old is None or new[0] < old[0]:
+            yield None, new
+            new = next(new_rows, None)
+        else:
+            if same_capture_process(old, new):
+                yield old, new
+            else:
+                yield old, None
+                yield None, new
+            old = next(old_rows, None)
+            new = next(new_rows, None)
+
+
+# utility to pair up the processes of two unsorted captures
+# the old capture is kept in a hash by pid and the new one is streamed
+# against it, the processes left over have exited.
+def hash_join_captures(old_path, new_path):
+    olds = {}
+    for old in read_capture(old_path):
+        olds[old[0]] = old
+    for new in read_capture(new_path):
+        old = olds.pop(new[0], None)
+        if old is not None and not same_capture_process(old, new):
+            yield old, None
+            old = None
+        yield old, new
+    for pid in sorted(olds):
+        yield olds[pid], None
+
+
+# compare two CSV captures: the new, exited and grown processes, or with
+# "-r user"/"-r program" the change per group.
+# rows are streamed in PID order, with "-n" only the biggest URES changes
+# are kept (biggest first).
+def run_diff(args):
+    old_path, new_path = args.diff
+    reports = []
+    for report in args.reports or []:
+        if report not in DIFF_REPORTS:
+            print '[ERROR] "--diff" can only report by %s.' % ' or '.join(DIFF_REPORTS)
+            sys.exit(1)
+        if report not in reports:
+            reports.append(report)
+
+    if capture_sorted_by_pid(old_path) and capture_sorted_by_pid(new_path):
+        pairs = merge_captures(old_path, new_path)
+    else:
+        pairs = hash_join_captures(old_path, new_path)
+
+    result_rows_limit = None
+    if args.lines_of_output and int(args.lines_of_output) > 0:
+        result_rows_limit = int(args.lines_of_output)
+
+    # report -> group -> [old count, old URES, new count, new URES]
+    aggregates = dict((report, {}) for report in reports)
+
+    def changes():
+        for old, new in pairs:
+            row = new or old
+            if args.user and row[1] != args.user:
+                continue
+            for report in reports:
+                if report == 'user':
+                    key = row[1]
+                else:
+                    key = os.path.basename(row[7].split(' ', 1)[0]).rstrip(':')
+                group = aggregates[report].setdefault(key, [0, 0, 0, 0])
+                if old is not None:
+                    group[0] += 1
+                    group[1] += old[2]
+                if new is not None:
+                    group[2] += 1
+                    group[3] += new[2]
+            if reports:
+                continue
+            if old is None:
+                status = 'new'
+                old_values = (None, 0, 0, 0, 0)
+            elif new is None:
+                status = 'exited'
+                new_values = (None, 0, 0, 0, 0)
+            elif new[2] > old[2]:
+                status = 'grown'
+            else:
+                continue
+            if old is not None:
+                old_values = old[1:6]
+            if new is not None:
+                new_values = new[1:6]
+            yield [status, row[0], row[1], old_values[1], new_values[1],
+                   new_values[1] - old_values[1], new_values[2] - old_values[2],
+                   new_values[3] - old_values[3], new_values[4] - old_values[4],
+                   row[6], row[7]]
+
+    header = ["STATUS", "PID", "UID", "OLD-URES", "NEW-URES", "dURES", "dVIRT",
+              "dMINFLT", "dMAJFLT", "started", "CMD"]
+    rows = changes()
+    if result_rows_limit:
+        rows = heapq.nlargest(result_rows_limit, rows, key=lambda r: abs(r[5]))
+
+    out, write_header = open_output(args)
+    try:
+        if reports:
+            # the groups are summed while the pairs are consumed
+            for row in rows:
+                pass
+            group_header = ["OLD-COUNT", "NEW-COUNT", "OLD-URES", "NEW-URES", "dURES"]
+            if structured_output(args):
+                writer = RowWriter(out, ["report", "group"] + group_header,
+                                   args.json_output, write_header)
+            for report in reports:
+                groups = aggregates[report].items()
+                groups.sort(key=lambda x: (abs(x[1][3] - x[1][1]), x[1][3]), reverse=True)
+                if structured_output(args):
+                    for key, g in groups:
+                        writer.write_row([report, key, g[0], g[2], g[1], g[3], g[3] - g[1]])
+                    continue
+                print_label("URES change by " + report)
+                table = JustifiedTable()
+                table.add_row([report.upper()] + group_header)
+                for key, g in groups:
+                    table.add_row([key, g[0], g[2], g[1], g[3], g[3] - g[1]])
+                table.output(None)
+        elif structured_output(args):
+            writer = RowWriter(out, header, args.json_output, write_header)
+            for row in rows:
+                writer.write_row(row)
+        else:
+            table = JustifiedTable()
+            table.add_row(header)
+            for row in rows:
+                table.add_row(row)
+            table.output(None)
+    finally:
+        close_output(out)
+
+
+# utility to escape a Prometheus label value
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# utility class that collects the processes in a background thread and
+# keeps the rendered Prometheus text of the latest snapshot, so a scrape
+# never walks /proc itself.
+# the fault and cpu counters are kept per backend type: every sample adds
+# the growth of the processes since the previous sample (or all of it for
+# new ones), so the counters do not go down when processes exit.
+# per-process series are limited to the top_k processes by memory to keep
+# the label cardinality bounded.
+# with "-r query" the backends are also summed per query fingerprint, for
+# the top_k fingerprints by memory. the fingerprints of the query texts
+# are kept in FINGERPRINT_CACHE from one snapshot to the next. an error
+# of the database only loses the queries of that snapshot.
+class MetricsCollector(threading.Thread):
+    def __init__(self, args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.args = args
+        self.interval = args.interval or EXPORTER_INTERVAL
+        self.lock = threading.Lock()
+        self.text = ''
+        # (pid, starttime) -> (minflt, majflt, utime, stime) of the
+        # previous sample
+        self.previous = {}
+        # backend type -> [minflt, majflt, utime, stime]
+        self.counters = {}
+        self.cache = ProcessCache()
+        self.reports = ['type', 'user']
+        if args.reports and 'query' in args.reports:
+            self.reports.append('query')
+        # the queries are attached separately, without ending the exporter
+        self.collect_args = argparse.Namespace(**vars(args))
+        self.collect_args.postgres_query = False
+        self.collect_args.memory_contexts = False
+
+    def run(self):
+        while True:
+            started = time.time()
+            try:
+                self.collect()
+            except Exception as err:
+                print >> sys.stderr, '[WARNING] Collection failed: %s' % err
+            time.sleep(max(0, started + self.interval - time.time()))
+
+    def collect(self):
+        started = time.time()
+        pinfos = get_process_infos(self.collect_args, cache=self.cache, status=False)
+        if self.args.postgres_query:
+            kernel_uptime = int(float(parse_delim_file(PROC_ROOT + "/uptime")[0]) * 100)
+            attach_postgres_queries(pinfos, kernel_uptime, None, self.args, fatal=False)
+        record_history(self.args, pinfos, started)
+        aggregates = get_aggregates(pinfos, self.reports, self.args.pss)
+
+        current = {}
+        for pinfo in pinfos.itervalues():
+            key = (pinfo.pid, pinfo.starttime)
+            values = (pinfo.minflt, pinfo.majflt, pinfo.utime, pinfo.stime)
+            current[key] = values
+            prev = self.previous.get(key, (0, 0, 0, 0))
+            counters = self.counters.setdefault(get_backend_type(pinfo), [0, 0, 0, 0])
+            for i in range(4):
+                counters[i] += values[i] - prev[i]
+        self.previous = current
+
+        text = self.render(pinfos, aggregates, time.time() - started)
+        with self.lock:
+            self.text = text
+
+    def render(self, pinfos, aggregates, duration):
+        mem = "ures"
+        if self.args.pss:
+            mem = "pss"
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in samples:
+                if isinstance(value, float):
+                    value = repr(value)
+                if labels:
+                    label_text = ','.join('%s="%s"' % (k, escape_label(v)) for k, v in labels)
+                    lines.append('%s{%s} %s' % (name, label_text, value))
+                else:
+                    lines.append('%s %s' % (name, value))
+
+        for report, label in (('type', 'backend_type'), ('user', 'user')):
+            groups = sorted(aggregates[report].items())
+            metric('pg_meminfo_%s_%s_kilobytes' % (report, mem), 'gauge',
+                   'Sum of %s of the processes per %s.' % (mem.upper(), label),
+                   [([(label, k)], g[1]) for k, g in groups])
+            metric('pg_meminfo_%s_processes' % report, 'gauge',
+                   'Number of processes per %s.' % label,
+                   [([(label, k)], g[0]) for k, g in groups])
+
+        if 'query' in aggregates:
+            groups = heapq.nlargest(self.args.top_k, aggregates['query'].items(),
+                                    key=lambda x: x[1][1])
+            metric('pg_meminfo_query_%s_kilobytes' % mem, 'gauge',
+                   'Sum of %s of the backends per query fingerprint, for the '
+                   'top %d fingerprints.' % (mem.upper(), self.args.top_k),
+                   [([('query', k)], g[1]) for k, g in groups])
+            metric('pg_meminfo_query_processes', 'gauge',
+                   'Number of backends per query fingerprint, for the top %d '
+                   'fingerprints.' % self.args.top_k,
+                   [([('query', k)], g[0]) for k, g in groups])
+
+        counters = sorted(self.counters.items())
+        metric('pg_meminfo_minor_faults_total', 'counter',
+               'Minor page faults of the processes per backend_type.',
+               [([('backend_type', k)], c[0]) for k, c in counters])
+        metric('pg_meminfo_major_faults_total', 'counter',
+               'Major page faults of the processes per backend_type.',
+               [([('backend_type', k)], c[1]) for k, c in counters])
+        metric('pg_meminfo_cpu_seconds_total', 'counter',
+               'CPU time of the processes per backend_type and mode.',
+               [([('backend_type', k), ('mode', 'user')], c[2] / float(USER_HZ))
+                for k, c in counters] +
+               [([('backend_type', k), ('mode', 'system')], c[3] / float(USER_HZ))
+                for k, c in counters])
+
+        if self.args.pss:
+            top = heapq.nlargest(self.args.top_k, pinfos.itervalues(),
+                                 key=lambda p: (p.smaps or {}).get("PSS", 0))
+        else:
+            top = heapq.nlargest(self.args.top_k, pinfos.itervalues(),
+                                 key=lambda p: p.ures)
+        samples = []
+        for pinfo in top:
+            if self.args.pss:
+                value = (pinfo.smaps or {}).get("PSS", 0)
+            else:
+                value = pinfo.ures
+            samples.append(([('pid', pinfo.pid),
+                             ('backend_type', get_backend_type(pinfo)),
+                             ('user', NAME_CACHE.get_uid(pinfo.uid))], value))
+        metric('pg_meminfo_top_process_%s_kilobytes' % mem, 'gauge',
+               '%s of the top %d processes by memory.' % (mem.upper(), self.args.top_k),
+               samples)
+
+        metric('pg_meminfo_collection_seconds', 'gauge',
+               'Time spent collecting the latest snapshot.', [([], duration)])
+        metric('pg_meminfo_collection_timestamp_seconds', 'gauge',
+               'When the latest snapshot was collected.', [([], time.time())])
+        return '\n'.join(lines) + '\n'
+
+    def get_text(self):
+        with self.lock:
+            return self.text
+
+
+# utility class to answer scrapes from the collector's snapshot
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    collector = None
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.collector.get_text()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # keep the scrapes out of the output
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+# exporter mode: collect in the background and serve /metrics
+def run_exporter(args):
+    collector = MetricsCollector(args)
+    # have a snapshot before the first scrape can come in
+    collector.collect()
+    collector.start()
+    MetricsHandler.collector = collector
+    server = MetricsServer((args.exporter_address, args.exporter_port), MetricsHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# utility class that keeps a moving estimate of the URES growth rate of
+# every process and flags the ones growing too fast or too big.
+# the state per (pid, starttime) is a fixed size list of
+# [time of last sample, URES of last sample, growth rate, flagged] and is
+# dropped as soon as the process is gone, so memory stays bounded by the
+# number of live processes.
+# the growth rate is an exponentially weighted moving average of the
+# rate between consecutive samples.
+class GrowthDetector:
+    def __init__(self, growth_rate, ures_limit=None, alpha=WATCH_ALPHA):
+        self.growth_rate = growth_rate
+        self.ures_limit = ures_limit
+        self.alpha = alpha
+        self.state = {}
+
+    # feed one sample of (pid, starttime) -> URES
+    # returns a list of (key, URES, growth rate, reason) of the processes
+    # that crossed a threshold with this sample
+    def update(self, samples, now):
+        alpha = self.alpha
+        state = self.state
+        flagged = []
+        for key in state.keys():
+            if key not in samples:
+                del state[key]
+        for key, ures in samples.iteritems():
+            st = state.get(key)
+            if st is None:
+                state[key] = [now, ures, 0.0, False]
+                continue
+            elapsed = now - st[0]
+            if elapsed <= 0:
+                continue
+            rate = (ures - st[1]) / elapsed
+            st[2] += alpha * (rate - st[2])
+            st[0] = now
+            st[1] = ures
+            reason = None
+            if st[2] >= self.growth_rate:
+                reason = 'growth'
+            elif self.ures_limit is not None and ures >= self.ures_limit:
+                reason = 'limit'
+            # only report a process when it starts to be over a threshold
+            if reason is not None and not st[3]:
+                flagged.append((key, ures, st[2], reason))
+            st[3] = reason is not None
+        return flagged
+
+
+# utility to read the time every cpu has spent busy from /proc/stat
+# returns a hash of cpu number -> [busy ticks, total ticks]
+# idle and iowait are the only ticks not counted as busy.
+def get_cpu_times():
+    times = {}
+    try:
+        lines = parse_split_file(PROC_ROOT + "/stat")
+    except (IOError, OSError):
+        return times
+    for line in lines:
+        if not line or not line[0].startswith('cpu') or line[0] == 'cpu':
+            continue
+        ticks = [int(x) for x in line[1:]]
+        total = sum(ticks[:8])
+        times[int(line[0][3:])] = [total - ticks[3] - ticks[4], total]
+    return times
+
+
+# utility to parse a kernel cpu list, eg. "0-3,8-11"
+def parse_cpu_list(cpulist):
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+# utility to map every cpu to its NUMA node
+# returns an empty hash on kernels or machines without NUMA information
+def get_numa_nodes():
+    nodes = {}
+    try:
+        names = os.listdir(NUMA_NODE_ROOT)
+    except OSError:
+        return nodes
+    for name in names:
+        if not name.startswith('node') or not name[4:].isdigit():
+            continue
+        try:
+            cpulist = read_proc_file("%s/%s/cpulist" % (NUMA_NODE_ROOT, name))
+        except (IOError, OSError):
+            continue
+        for cpu in parse_cpu_list(cpulist):
+            nodes[cpu] = int(name[4:])
+    return nodes
+
+
+# utility to sum the CPU% of the processes per group
+# returns a hash of group -> [count, CPU%, URES, top CPU%, pid of the top]
+def get_cpu_groups(rates, key):
+    groups = {}
+    for rate in rates:
+        group_key = key(rate["pinfo"])
+        pct = rate["utime_pct"] + rate["stime_pct"]
+        group = groups.get(group_key)
+        if group is None:
+            groups[group_key] = [1, pct, rate["pinfo"].ures, pct,
+                                 rate["pinfo"].pid]
+            continue
+        group[0] += 1
+        group[1] += pct
+        group[2] += rate["pinfo"].ures
+        if pct > group[3]:
+            group[3] = pct
+            group[4] = rate["pinfo"].pid
+    return groups
+
+
+# CPU load mode: two readings "--cpu-load" seconds apart, the second only
+# of the processes found by the first.
+# reports CPU% per process (sorted by it, with URES to compare), per backend
+# type, per core the processes last ran on (with the busy% of the core from
+# /proc/stat) and per NUMA node. a warning is printed when the busy% of
+# the NUMA nodes is more than CPU_IMBALANCE apart.
+def run_cpu_load(args):
+    first_pinfos = get_process_infos(args, status=False)
+    first_cpus = get_cpu_times()
+    first_time = time.time()
+    time.sleep(args.cpu_load)
+    pinfos = get_process_infos(args, sorted(first_pinfos.keys()), status=False)
+    cpus = get_cpu_times()
+    now = time.time()
+    rates = get_process_rates(first_pinfos, pinfos, now - first_time)
+    rates.sort(key=lambda r: (r["utime_pct"] + r["stime_pct"], r["pinfo"].ures),
+               reverse=True)
+
+    busy = {}
+    for cpu, (ticks, total) in cpus.iteritems():
+        if cpu in first_cpus and total > first_cpus[cpu][1]:
+            busy[cpu] = 100.0 * (ticks - first_cpus[cpu][0]) / (total - first_cpus[cpu][1])
+    nodes = get_numa_nodes()
+
+    by_type = get_cpu_groups(rates, get_backend_type)
+    by_core = get_cpu_groups(rates, lambda p: p.cpu)
+    for cpu in busy:
+        if cpu not in by_core:
+            by_core[cpu] = [0, 0.0, 0, 0.0, None]
+    by_node = {}
+    if nodes:
+        by_node = get_cpu_groups(rates, lambda p: nodes.get(p.cpu))
+        for node in set(nodes.values()):
+            if node not in by_node:
+                by_node[node] = [0, 0.0, 0, 0.0, None]
+    node_busy = {}
+    for node in by_node:
+        node_cpus = [busy[c] for c, n in nodes.iteritems() if n == node and c in busy]
+        if node_cpus:
+            node_busy[node] = sum(node_cpus) / len(node_cpus)
+
+    result_rows_limit = None
+    if args.lines_of_output and int(args.lines_of_output) > 0:
+        result_rows_limit = int(args.lines_of_output)
+    if result_rows_limit:
+        rates = rates[:result_rows_limit]
+
+    sections = [('type', by_type, {}), ('core', by_core, busy),
+                ('node', by_node, node_busy)]
+    header = ["COUNT", "CPU%", "URES", "TOP-CPU%", "TOP-PID", "BUSY%"]
+    out, write_header = open_output(args)
+    try:
+        if structured_output(args):
+            writer = RowWriter(out, ["report", "group"] + header,
+                               args.json_output, write_header)
+            for rate in rates:
+                pct = round(rate["utime_pct"] + rate["stime_pct"], 1)
+                writer.write_row(['process', rate["pinfo"].pid, 1, pct,
+                                  rate["pinfo"].ures, pct, rate["pinfo"].pid, None])
+            for report, groups, group_busy in sections:
+                for key in sorted(groups):
+                    group = groups[key]
+                    busy_pct = None
+                    if key in group_busy:
+                        busy_pct = round(group_busy[key], 1)
+                    writer.write_row([report, key, group[0], round(group[1], 1),
+                                      group[2], round(group[3], 1), group[4],
+                                      busy_pct])
+        else:
+            print_label("Processes by CPU%")
+            table = JustifiedTable()
+            table.add_row(["PID", "UID", "URES", "CPU%", "USR%", "SYS%", "CPU",
+                           "started", "S", "CMD"])
+            for rate in rates:
+                pinfo = rate["pinfo"]
+                table.add_row([pinfo.pid, NAME_CACHE.get_uid(pinfo.uid),
+                               pinfo.ures,
+                               round(rate["utime_pct"] + rate["stime_pct"], 1),
+                               round(rate["utime_pct"], 1),
+                               round(rate["stime_pct"], 1), pinfo.cpu,
+                               get_elapsed(pinfo.exists_for), pinfo.state,
+                               pinfo.cmd])
+            table.output(None)
+            for report, groups, group_busy in sections:
+                if not groups:
+                    continue
+                print_label("CPU load by " + report)
+                table = JustifiedTable()
+                table.add_row([report.upper()] + header)
+                for key in sorted(groups):
+                    group = groups[key]
+                    busy_pct = ''
+                    if key in group_busy:
+                        busy_pct = round(group_busy[key], 1)
+                    table.add_row([key, group[0], round(group[1], 1), group[2],
+                                   round(group[3], 1), group[4], busy_pct])
+                table.output(None)
+    finally:
+        close_output(out)
+
+    if len(node_busy) > 1:
+        low = min(node_busy, key=node_busy.get)
+        high = max(node_busy, key=node_busy.get)
+        if node_busy[high] - node_busy[low] > CPU_IMBALANCE:
+            print >> sys.stderr, '[WARNING] NUMA nodes are unevenly loaded: node %d is %.1f%% busy, node %d is %.1f%% busy' % (
+                high, node_busy[high], low, node_busy[low])
+
+
+# watch mode: report the processes the GrowthDetector flags
+# every sample only reads stat and statm, the full details (and with
+# "-p" the query) are only collected for the flagged processes.
+def run_watch(args):
+    interval = args.interval or WATCH_INTERVAL
+    detector = GrowthDetector(args.growth_rate, args.ures_limit, args.ewma_alpha)
+    uid = get_filter_uid(args)
+    header = ["epoch_time", "PID", "UID", "URES", "RATE", "REASON", "CMD",
+              "qry_state", "qry_waiting", "query"]
+
+    # the queries are attached separately, a database error while a
+    # backend runs away is only warned about
+    collect_args = argparse.Namespace(**vars(args))
+    collect_args.postgres_query = False
+    collect_args.memory_contexts = False
+
+    out, write_header = open_output(args)
+    writer = None
+    if structured_output(args):
+        writer = RowWriter(out, header, args.json_output, write_header)
+    try:
+        while True:
+            started = time.time()
+            flagged = detector.update(get_ures_samples(discover_pids(args), uid), started)
+            if flagged:
+                pinfos = get_process_infos(collect_args, [key[0] for key, u, r, w in flagged])
+                if args.postgres_query:
+                    kernel_uptime = int(float(parse_delim_file(PROC_ROOT + "/uptime")[0]) * 100)
+                    attach_postgres_queries(pinfos, kernel_uptime, None, args, fatal=False)
+                for key, ures, rate, reason in flagged:
+                    pinfo = pinfos.get(key[0])
+                    if pinfo is None or pinfo.starttime != key[1]:
+                        # gone since the sample
+                        continue
+                    row = [started, key[0], NAME_CACHE.get_uid(pinfo.uid), ures,
+                           int(rate), reason, pinfo.cmd,
+                           pinfo.qry_state or '', pinfo.waiting_state or '',
+                           pinfo.query or '']
+                    if writer is not None:
+                        writer.write_row(row)
+                    else:
+                        print >> out, '%s pid %d (%s) URES %d kB growing %d kB/s [%s] %s' % (
+                            time.strftime("%H:%M:%S", time.localtime(started)),
+                            key[0], row[2], ures, rate, reason, pinfo.cmd)
+                        if pinfo.query:
+                            print >> out, '    %s: %s' % (pinfo.qry_state, pinfo.query)
+                out.flush()
+            time.sleep(max(0, started + interval - time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_output(out)
+
+
+# utility to register a PSI trigger on a pressure file
+# returns the descriptor to poll for POLLPRI, the trigger lives as long as
+# the descriptor is open
+def open_pressure_trigger(path, trigger):
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    except OSError as err:
+        if err.errno == errno.ENOENT:
+            print '[ERROR] %s does not exist, the kernel has no pressure stall information (PSI).' % path
+        else:
+            print '[ERROR] Cannot open %s: %s' % (path, err.strerror)
+        sys.exit(1)
+    try:
+        os.write(fd, trigger + '\0')
+    except OSError as err:
+        os.close(fd)
+        if err.errno in (errno.EPERM, errno.EACCES):
+            print '[ERROR] Not allowed to register "%s" on %s, it needs root or a window of a multiple of 2 seconds.' % (trigger, path)
+        else:
+            print '[ERROR] Cannot register "%s" on %s: %s' % (trigger, path, err.strerror)
+        sys.exit(1)
+    return fd
+
+
+# utility to take one sample of a pressure capture: every process with
+# the query of the backends. the database may well be slow to answer
+# under memory pressure, so an error there only loses the queries.
+def get_pressure_sample(args):
+    collect_args = argparse.Namespace(**vars(args))
+    collect_args.postgres_query = False
+    collect_args.memory_contexts = False
+    pinfos = get_process_infos(collect_args)
+    kernel_uptime = int(float(parse_delim_file(PROC_ROOT + "/uptime")[0]) * 100)
+    attach_postgres_queries(pinfos, kernel_uptime, None, args, fatal=False)
+    return pinfos
+
+
+# utility to write a pressure capture: the first sample right away, then
+# "--burst" more. every row carries the sample time and the pressure
+# averages of the moment, the file is named after the time of the trigger.
+# returns the file name and the number of rows written
+def write_pressure_capture(args, pressure_path, started):
+    ext = '.csv'
+    if args.json_output:
+        ext = '.json'
+    filename = os.path.join(args.pressure_dir, time.strftime(
+        'pg_meminfo-pressure-%Y%m%d-%H%M%S', time.localtime(started)) + ext)
+    header = ["epoch_time", "pressure", "PID", "UID", "URES", "SHR", "VIRT",
+              "MINFLT", "MAJFLT", "CPU", "threads", "started", "S", "CMD",
+              "qry_state", "qry_waiting", "query"]
+    interval = args.interval or PRESSURE_BURST_INTERVAL
+    rows = 0
+    out = open(filename, 'wb', OUTPUT_BUFFER_SIZE)
+    try:
+        writer = RowWriter(out, header, args.json_output)
+        for sample in range(args.burst + 1):
+            if sample:
+                time.sleep(max(0, started + sample * interval - time.time()))
+            pinfos = get_pressure_sample(args)
+            now = time.time()
+            try:
+                pressure = ' '.join(read_proc_file(pressure_path).split('\n')[0].split()[1:4])
+            except (IOError, OSError):
+                pressure = ''
+            plist = sorted(pinfos.itervalues(), key=lambda p: p.ures, reverse=True)
+            for pinfo in plist:
+                writer.write_row([now, pressure, pinfo.pid,
+                                  NAME_CACHE.get_uid(pinfo.uid), pinfo.ures,
+                                  pinfo.shared, pinfo.vmsize, pinfo.minflt,
+                                  pinfo.majflt, pinfo.cpu, pinfo.threads,
+                                  get_elapsed(pinfo.exists_for, now), pinfo.state,
+                                  pinfo.cmd, pinfo.qry_state or '',
+                                  pinfo.waiting_state or '', pinfo.query or ''])
+            rows += len(plist)
+            out.flush()
+    finally:
+        out.close()
+    return filename, rows
+
+
+# pressure mode: sleep in poll() on a PSI trigger of the memory pressure
+# of the host (or of the cgroup) and write a capture when it fires.
+# captures are at least "--cooldown" seconds apart, the triggers in
+# between are only counted.
+def run_pressure(args):
+    pressure_path = PROC_ROOT + "/pressure/memory"
+    cgroup_dir = get_args_cgroup_dir(args)
+    if cgroup_dir is not None:
+        pressure_path = os.path.join(cgroup_dir, "memory.pressure")
+    elif args.cgroup or args.pgdata or args.postmaster_pid:
+        print '[ERROR] The cgroup v2 to watch was not found.'
+        sys.exit(1)
+    if not os.path.isdir(args.pressure_dir):
+        print '[ERROR] %s is not a directory.' % args.pressure_dir
+        sys.exit(1)
+
+    fd = open_pressure_trigger(pressure_path, args.pressure_trigger)
+    poller = select.poll()
+    poller.register(fd, select.POLLPRI)
+    print >> sys.stderr, 'waiting for "%s" on %s' % (args.pressure_trigger, pressure_path)
+    last_capture = None
+    suppressed = 0
+    try:
+        while True:
+            events = poller.poll()
+            now = time.time()
+            if any(event & select.POLLERR for dummy, event in events):
+                print '[ERROR] The pressure trigger on %s went away.' % pressure_path
+                sys.exit(1)
+            if last_capture is not None and now - last_capture < args.cooldown:
+                suppressed += 1
+                continue
+            last_capture = now
+            try:
+                filename, rows = write_pressure_capture(args, pressure_path, now)
+            except IOError as err:
+                print >> sys.stderr, '[WARNING] Cannot write the capture: %s' % err
+                continue
+            msg = '%s memory pressure: %d rows in %d samples written to %s' % (
+                time.strftime("%H:%M:%S", time.localtime(now)), rows,
+                args.burst + 1, filename)
+            if suppressed:
+                msg += ' (%d triggers skipped since the previous capture)' % suppressed
+                suppressed = 0
+            print msg
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(fd)
+
+
+# utility to subscribe to the process events of the kernel proc connector
+# returns the netlink socket, or None (with the reason) when it is not
+# available: not Linux, not root, or a kernel without the connector
+def open_proc_connector():
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+    except (AttributeError, socket.error) as err:
+        return None, str(err)
+    try:
+        sock.bind((0, CN_IDX_PROC))
+        op = struct.pack('=I', PROC_CN_MCAST_LISTEN)
+        cn_msg = CN_MSG_HEADER.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(op), 0)
+        sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(cn_msg) + len(op),
+                                    NLMSG_DONE, 0, 0, 0) + cn_msg + op)
+    except socket.error as err:
+        sock.close()
+        return None, str(err)
+    return sock, None
+
+
+# utility to parse a datagram of the proc connector
+# yields (event, pid, parent pid) of the processes (not the threads) that
+# forked, exec'd or exited, the parent pid is only set for forks
+def parse_proc_events(data):
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        length = NLMSG_HEADER.unpack_from(data, offset)[0]
+        if length < NLMSG_HEADER.size:
+            return
+        event_offset = offset + NLMSG_HEADER.size + CN_MSG_HEADER.size
+        ids_offset = event_offset + PROC_EVENT_HEADER.size
+        offset += (length + 3) & ~3
+        if ids_offset + PROC_EVENT_IDS.size > len(data):
+            continue
+        what = PROC_EVENT_HEADER.unpack_from(data, event_offset)[0]
+        ids = PROC_EVENT_IDS.unpack_from(data, ids_offset)
+        if what == PROC_EVENT_FORK:
+            # parent pid, parent tgid, child pid, child tgid
+            if ids[2] == ids[3]:
+                yield what, ids[3], ids[1]
+        elif what in (PROC_EVENT_EXEC, PROC_EVENT_EXIT):
+            # pid, tgid
+            if ids[0] == ids[1]:
+                yield what, ids[1], None
+
+
+# utility to parse the netlink attributes of data[offset:end]
+# yields (type, payload) of every attribute
+def parse_nlattrs(data, offset, end):
+    while offset + NLATTR_HEADER.size <= end:
+        length, kind = NLATTR_HEADER.unpack_from(data, offset)
+        if length < NLATTR_HEADER.size:
+            return
+        yield kind & NLA_TYPE_MASK, data[offset + NLATTR_HEADER.size:offset + length]
+        offset += (length + 3) & ~3
+
+
+# utility to send a generic netlink request with one attribute and wait for
+# its acknowledgement
+# returns the attributes of the reply, raises socket.error if it failed
+def genl_request(sock, family, cmd, kind, value):
+    length = NLATTR_HEADER.size + len(value)
+    attr = NLATTR_HEADER.pack(length, kind) + value + '\0' * (-length % 4)
+    body = GENL_HEADER.pack(cmd, 1, 0) + attr
+    sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(body), family,
+                                NLM_F_REQUEST | NLM_F_ACK, 0, 0) + body)
+    attrs = {}
+    while True:
+        data = sock.recv(65536)
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            length, msg_type = NLMSG_HEADER.unpack_from(data, offset)[:2]
+            if length < NLMSG_HEADER.size:
+                break
+            if msg_type == NLMSG_ERROR:
+                error = -struct.unpack_from('=i', data, offset + NLMSG_HEADER.size)[0]
+                if error:
+                    raise socket.error(error, os.strerror(error))
+                return attrs
+            if msg_type == family:
+                attrs.update(parse_nlattrs(data, offset + NLMSG_HEADER.size + GENL_HEADER.size,
+                                           min(offset + length, len(data))))
+            offset += (length + 3) & ~3
+
+
+# utility to subscribe to the taskstats exit records of all the cpus
+# returns the netlink socket, or None (with the reason) when it is not
+# available: not Linux, not root, or a kernel without taskstats
+def open_taskstats():
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+    except (AttributeError, socket.error) as err:
+        return None, str(err)
+    try:
+        cpus = read_proc_file("/sys/devices/system/cpu/possible").strip()
+    except (IOError, OSError):
+        cpus = '0-%d' % (os.sysconf('SC_NPROCESSORS_CONF') - 1)
+    try:
+        sock.bind((0, 0))
+        attrs = genl_request(sock, GENL_ID_CTRL, CTRL_CMD_GETFAMILY,
+                             CTRL_ATTR_FAMILY_NAME, 'TASKSTATS\0')
+        if CTRL_ATTR_FAMILY_ID not in attrs:
+            sock.close()
+            return None, 'no taskstats family'
+        family = struct.unpack_from('=H', attrs[CTRL_ATTR_FAMILY_ID])[0]
+        genl_request(sock, family, TASKSTATS_CMD_GET,
+                     TASKSTATS_CMD_ATTR_REGISTER_CPUMASK, cpus + '\0')
+    except socket.error as err:
+        sock.close()
+        return None, str(err)
+    return sock, None
+
+
+# utility to parse a datagram of taskstats exit records
+# yields (pid, lived seconds, VmHWM) of every task that exited. the pid is
+# the one of the thread, which is the process for the single threaded
+# postgres processes.
+def parse_taskstats(data):
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        length, msg_type = NLMSG_HEADER.unpack_from(data, offset)[:2]
+        if length < NLMSG_HEADER.size:
+            return
+        end = min(offset + length, len(data))
+        if msg_type > GENL_ID_CTRL:
+            for kind, value in parse_nlattrs(data, offset + NLMSG_HEADER.size + GENL_HEADER.size, end):
+                if kind != TASKSTATS_TYPE_AGGR_PID:
+                    continue
+                for kind, stats in parse_nlattrs(value, 0, len(value)):
+                    if kind == TASKSTATS_TYPE_STATS and \
+                            len(stats) >= TASKSTATS_EXIT_OFFSET + TASKSTATS_EXIT.size:
+                        fields = TASKSTATS_EXIT.unpack_from(stats, TASKSTATS_EXIT_OFFSET)
+                        yield fields[0], fields[4] / 1000000.0, fields[11]
+        offset += (length + 3) & ~3
+
+
+# utility to read all of the queued taskstats exit records, without waiting
+def read_taskstats(sock):
+    while True:
+        try:
+            data = sock.recv(65536, socket.MSG_DONTWAIT)
+        except socket.error as err:
+            if err.errno == errno.ENOBUFS:
+                print >> sys.stderr, '[WARNING] Lost taskstats records, the peak of some exits is only sampled.'
+                continue
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        for record in parse_taskstats(data):
+            yield record
+
+
+# utility class to follow a set of postgres processes between their start
+# and exit and keep the peak of their memory. every sample reads statm,
+# stat and status (for VmHWM) of the followed processes only. the lifetime
+# and VmHWM at exit come from taskstats when it is there.
+# pid -> [starttime, uid, cmd, peak URES, peak HWRES, samples, lived seconds]
+class ProcessTracker:
+    def __init__(self, uid=None):
+        self.uid = uid
+        self.processes = {}
+
+    def kernel_uptime(self):
+        return int(float(parse_delim_file(PROC_ROOT + "/uptime")[0]) * 100)
+
+    # start following a process, returns false if it is not there, not of
+    # the user that is followed or not a postgres process
+    def add(self, pid, kernel_uptime=None):
+        if kernel_uptime is None:
+            kernel_uptime = self.kernel_uptime()
+        pinfo = get_process_info(pid, kernel_uptime, self.uid)
+        if pinfo is None or get_backend_type(pinfo) == 'other':
+            return False
+        self.processes[pid] = [pinfo.starttime, pinfo.uid, pinfo.cmd, 0, 0, 0, None]
+        self.update(pinfo)
+        return True
+
+    def update(self, pinfo):
+        entry = self.processes[pinfo.pid]
+        # the title of a backend changes with what it does, the last one
+        # is reported
+        entry[2] = pinfo.cmd
+        entry[3] = max(entry[3], pinfo.ures)
+        entry[4] = max(entry[4], pinfo.status('HWRES') or 0)
+        entry[5] += 1
+
+    # sample a followed process, returns false if it is gone (or its pid
+    # reused). a process that exec'd something else than postgres, eg. the
+    # shell of an archive_command, is not followed anymore.
+    def sample_process(self, pid, kernel_uptime):
+        pinfo = get_process_info(pid, kernel_uptime, self.uid)
+        if pinfo is None or pinfo.starttime != self.processes[pid][0]:
+            return False
+        if get_backend_type(pinfo) == 'other':
+            del self.processes[pid]
+        else:
+            self.update(pinfo)
+        return True
+
+    # sample every followed process
+    # returns the pids that are gone (or reused) since they were added
+    def sample(self):
+        kernel_uptime = self.kernel_uptime()
+        return [pid for pid in self.processes.keys()
+                if not self.sample_process(pid, kernel_uptime)]
+
+    # keep the taskstats exit record of a followed process: its exact
+    # lifetime, and its VmHWM at exit that the samples miss for a backend
+    # that lives for less than the interval
+    def exited(self, pid, lived, hiwater_rss):
+        entry = self.processes.get(pid)
+        if entry is not None:
+            entry[4] = max(entry[4], hiwater_rss)
+            entry[6] = lived
+
+    # stop following a process, returns its row:
+    # [epoch_time, PID, UID, lived seconds, samples, peak URES, peak HWRES, CMD]
+    # without a taskstats record the lifetime is counted from the start time
+    # of the process, up to now
+    def exit(self, pid, now=None):
+        entry = self.processes.pop(pid)
+        if now is None:
+            now = time.time()
+        lived = entry[6]
+        if lived is None:
+            lived = max(0, self.kernel_uptime() - entry[0]) / float(USER_HZ)
+        return [now, pid, NAME_CACHE.get_uid(entry[1]), round(lived, 3),
+                entry[5], entry[3], entry[4], entry[2]]
+
+
+# utility to tell which processes "--events" follows from a /proc walk:
+# the postmaster tree with "-D" or "-P", otherwise the postgres processes
+# (of the "-u" user)
+def get_event_pids(args, tracker):
+    pids = discover_pids(args)
+    if args.pgdata or args.postmaster_pid:
+        return pids
+    pinfos = scan_pids(pids, tracker.kernel_uptime(), tracker.uid)
+    return [pid for pid, pinfo in pinfos.iteritems()
+            if get_backend_type(pinfo) != 'other']
+
+
+# event mode: follow the postgres processes with the fork, exec and exit
+# events of the proc connector and report every one that exits with its
+# lifetime and the peak URES (and VmHWM) of its samples. the children of
+# a followed process are followed from their fork on, so a backend that
+# lives for less than the interval still gets the sample taken at its fork
+# and exec, until it execs something else than postgres. the taskstats
+# exit record of a followed process gives its exact lifetime and VmHWM,
+# it is queued before the exit event of the proc connector. without the
+# proc connector the same is done by walking /proc every interval, which
+# misses the processes that live in between.
+def run_events(args):
+    interval = args.interval or EVENTS_INTERVAL
+    tracker = ProcessTracker(get_filter_uid(args))
+    sock, reason = open_proc_connector()
+    if sock is None:
+        print >> sys.stderr, '[WARNING] The proc connector is not available (%s), scanning /proc every %s seconds instead.' % (reason, interval)
+    stats_sock, reason = open_taskstats()
+    if stats_sock is None:
+        print >> sys.stderr, '[WARNING] taskstats is not available (%s), the peak of the processes is only sampled.' % reason
+    socks = [s for s in (sock, stats_sock) if s is not None]
+
+    header = ["epoch_time", "PID", "UID", "lived", "samples", "peak_URES",
+              "peak_HWRES", "CMD"]
+    out, write_header = open_output(args)
+    writer = None
+    if structured_output(args):
+        writer = RowWriter(out, header, args.json_output, write_header)
+
+    def report(row):
+        if writer is not None:
+            writer.write_row(row)
+        else:
+            print >> out, '%s pid %d (%s) exited after %.1fs, peak URES %d kB, VmHWM %d kB: %s' % (
+                time.strftime("%H:%M:%S", time.localtime(row[0])), row[1], row[2],
+                row[3], row[5], row[6], row[7])
+        out.flush()
+
+    kernel_uptime = tracker.kernel_uptime()
+    for pid in get_event_pids(args, tracker):
+        tracker.add(pid, kernel_uptime)
+    next_sample = time.time() + interval
+    try:
+        while True:
+            timeout = max(0, next_sample - time.time())
+            readable = []
+            if not socks:
+                time.sleep(timeout)
+            else:
+                readable = select.select(socks, [], [], timeout)[0]
+            if stats_sock is not None and readable:
+                for pid, lived, hiwater_rss in read_taskstats(stats_sock):
+                    tracker.exited(pid, lived, hiwater_rss)
+            if sock in readable:
+                try:
+                    data = sock.recv(65536)
+                except socket.error as err:
+                    if err.errno != errno.ENOBUFS:
+                        raise
+                    # events were dropped, pick up the processes we missed
+                    print >> sys.stderr, '[WARNING] Lost proc connector events, rescanning /proc.'
+                    for pid in get_event_pids(args, tracker):
+                        if pid not in tracker.processes:
+                            tracker.add(pid)
+                    continue
+                for event, pid, ppid in parse_proc_events(data):
+                    if event == PROC_EVENT_FORK:
+                        if ppid in tracker.processes:
+                            tracker.add(pid)
+                    elif pid not in tracker.processes:
+                        continue
+                    elif event == PROC_EVENT_EXEC:
+                        tracker.sample_process(pid, tracker.kernel_uptime())
+                    else:
+                        report(tracker.exit(pid))
+            # a busy host has events all the time, the samples are
+            # still taken every interval
+            if readable and time.time() < next_sample:
+                continue
+
+            now = time.time()
+            next_sample = now + interval
+            for pid in tracker.sample():
+                report(tracker.exit(pid, now))
+            if sock is None:
+                # without events, the new processes are found by the walk
+                kernel_uptime = tracker.kernel_uptime()
+                for pid in get_event_pids(args, tracker):
+                    if pid not in tracker.processes:
+                        tracker.add(pid, kernel_uptime)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for s in socks:
+            s.close()
+        close_output(out)
+
+
+# utility to read the system wide memory counters from /proc/meminfo
+# returns a hash of field -> value in kilobytes (pages for HugePages_*)
+def get_system_memory():
+    meminfo = {}
+    for line in parse_split_file(PROC_ROOT + "/meminfo"):
+        if len(line) > 1:
+            meminfo[line[0].rstrip(':')] = int(line[1])
+    return meminfo
+
+
+# utility to find the cgroup v2 directory of a process
+# returns None if the process is not in a cgroup v2 hierarchy
+def get_process_cgroup(pid):
+    try:
+        lines = read_proc_file("%s/%d/cgroup" % (PROC_ROOT, pid)).split('\n')
+    except (IOError, OSError):
+        return None
+    for line in lines:
+        if line.startswith('0::'):
+            return find_cgroup_dir(line[3:])
+    return None
+
+
+# utility to find the directory of a cgroup v2 under the cgroup mount
+def find_cgroup_dir(cgroup):
+    if os.path.isabs(cgroup) and os.path.exists(os.path.join(cgroup, "memory.current")):
+        return cgroup
+    for root in CGROUP_ROOTS:
+        path = os.path.join(root, cgroup.lstrip('/'))
+        if os.path.exists(os.path.join(path, "memory.current")):
+            return path
+    return None
+
+
+# utility to read the memory accounting of a cgroup v2
+# returns a hash with "path", "current" and "max" in kilobytes ("max" is
+# None when unlimited) and the memory.stat fields in kilobytes
+def get_cgroup_memory(path):
+    cgroup = {"path": path}
+    try:
+        cgroup["current"] = int(read_proc_file(os.path.join(path, "memory.current"))) / 1024
+        limit = read_proc_file(os.path.join(path, "memory.max")).strip()
+        cgroup["max"] = None
+        if limit != 'max':
+            cgroup["max"] = int(limit) / 1024
+        for key, value in parse_split_file(os.path.join(path, "memory.stat")):
+            cgroup[key] = int(value) / 1024
+    except (IOError, OSError, ValueError):
+        return None
+    return cgroup
+
+
+# utility to find the cgroup to report: "--cgroup" or the one of the
+# postmaster of "-D"/"-P"
+def get_args_cgroup(args):
+    path = get_args_cgroup_dir(args)
+    if path is None:
+        return None
+    return get_cgroup_memory(path)
+
+
+# utility to find the directory of the cgroup of get_args_cgroup
+def get_args_cgroup_dir(args):
+    if args.cgroup:
+        return find_cgroup_dir(args.cgroup)
+    elif args.pgdata:
+        return get_process_cgroup(get_postmaster_pid(args.pgdata))
+    elif args.postmaster_pid:
+        return get_process_cgroup(args.postmaster_pid)
+    return None
+
+
+# utility to build the system memory section as a list of
+# (label, value) pairs, headroom first
+def get_system_rows(meminfo, cgroup):
+    rows = []
+    for field in MEMINFO_FIELDS:
+        if field in meminfo:
+            rows.append((field, meminfo[field]))
+    if 'CommitLimit' in meminfo and 'Committed_AS' in meminfo:
+        rows.insert(0, ('commit_headroom', meminfo['CommitLimit'] - meminfo['Committed_AS']))
+    if 'MemAvailable' in meminfo:
+        rows.insert(0, ('mem_available', meminfo['MemAvailable']))
+    if cgroup is not None:
+        rows.append(('cgroup', cgroup["path"]))
+        rows.append(('cgroup_current', cgroup["current"]))
+        rows.append(('cgroup_max', cgroup["max"]))
+        if cgroup["max"] is not None:
+            rows.insert(0, ('cgroup_headroom', cgroup["max"] - cgroup["current"]))
+        for field in CGROUP_STAT_FIELDS:
+            if field in cgroup:
+                rows.append(('cgroup_' + field, cgroup[field]))
+    return rows
+
+
+# utility to output the system memory section
+# as a table with labels, or as a single CSV/JSON row
+def output_system_memory(args, out=sys.stdout, write_header=True):
+    rows = get_system_rows(get_system_memory(), get_args_cgroup(args))
+    if structured_output(args):
+        writer = RowWriter(out, ["epoch_time"] + [label for label, value in rows],
+                           args.json_output, write_header)
+        writer.write_row([time.time()] + [value for label, value in rows])
+        return
+    print_label("System memory (kB, huge pages in pages)")
+    table = JustifiedTable()
+    for label, value in rows:
+        table.add_row([label, value])
+    table.output(None)
+
+
+# utility to get the cpu time used by this process and its finished
+# children (the workers of a process pool), in seconds
+def get_cpu_time():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+# utility class to hold the "--profile" measurements of a run:
+# phase -> [calls, wall seconds, cpu seconds], and the counters of
+# PROFILE_COUNTERS. a phase that runs more than once (the sampling modes)
+# is summed up.
+class Profile:
+    def __init__(self):
+        self.started = time.time()
+        self.cpu_started = get_cpu_time()
+        self.phases = {}
+        self.order = []
+        self.counters = dict((counter, 0) for counter in PROFILE_COUNTERS)
+        # the thread pool workers of "-j" count concurrently
+        self.lock = threading.Lock()
+
+    def begin(self):
+        return time.time(), get_cpu_time()
+
+    def end(self, phase, mark):
+        wall = time.time() - mark[0]
+        cpu = get_cpu_time() - mark[1]
+        with self.lock:
+            entry = self.phases.get(phase)
+            if entry is None:
+                entry = self.phases[phase] = [0, 0.0, 0.0]
+                self.order.append(phase)
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    # a file read by read_proc_file
+    def count_file(self, size):
+        with self.lock:
+            self.counters['files_opened'] += 1
+            self.counters['bytes_read'] += size
+
+    def report(self):
+        report = {
+            "started": round(self.started, 3),
+            "argv": sys.argv[1:],
+            "wall": round(time.time() - self.started, 6),
+            "cpu": round(get_cpu_time() - self.cpu_started, 6),
+            "phases": dict((phase, {"calls": entry[0],
+                                    "wall": round(entry[1], 6),
+                                    "cpu": round(entry[2], 6)})
+                           for phase, entry in self.phases.iteritems()),
+        }
+        report.update(self.counters)
+        return report
+
+
+# utilities for the measuring sites, which only cost a check of PROFILE
+# when "--profile" is not given
+def profile_begin():
+    if PROFILE is None:
+        return None
+    return PROFILE.begin()
+
+
+def profile_end(phase, mark):
+    if mark is not None:
+        PROFILE.end(phase, mark)
+
+
+def profile_count(counter, n=1):
+    if PROFILE is not None:
+        PROFILE.count(counter, n)
+
+
+# utility to start the profile of the run, written out when it ends
+# (also on errors and interrupts) to target: stderr, or a file where one
+# JSON object per run is appended
+def start_profile(target):
+    global PROFILE
+    PROFILE = Profile()
+    atexit.register(write_profile, target)
+
+
+def write_profile(target):
+    report = PROFILE.report()
+    if target != 'stderr':
+        try:
+            f = open(target, 'ab')
+            try:
+                f.write(json.dumps(report, sort_keys=True) + '\n')
+            finally:
+                f.close()
+            return
+        except IOError as err:
+            print >> sys.stderr, '[WARNING] Cannot write the profile to %s: %s' % (target, err.strerror)
+    print >> sys.stderr, 'profile: %.1f ms wall, %.1f ms cpu' % (
+        report["wall"] * 1000, report["cpu"] * 1000)
+    for phase in PROFILE.order:
+        entry = report["phases"][phase]
+        print >> sys.stderr, '  %-10s %9.1f ms wall %9.1f ms cpu %6d calls' % (
+            phase, entry["wall"] * 1000, entry["cpu"] * 1000, entry["calls"])
+    print >> sys.stderr, '  ' + ', '.join('%s %d' % (counter, report[counter])
+                                         for counter in PROFILE_COUNTERS)
+
+
+# report what reading smaps_rollup cost, so we know whether --pss is
+# cheap enough to use for high-frequency sampling. goes to stderr so
+# that it never ends up in the results.
+def print_smaps_rollup_cost():
+    reads, secs, denied = SMAPS_ROLLUP_COST
+    if denied:
+        print >> sys.stderr, '[WARNING] smaps_rollup: permission denied for %d processes, run as their owner or as root' % denied
+    if reads == 0:
+        if not denied:
+            print >> sys.stderr, 'smaps_rollup is not available on this kernel'
+        return
+    print >> sys.stderr, 'smaps_rollup: %d processes read in %.1f ms, %.1f us per process' % (
+        reads, secs * 1000, secs * 1000000 / reads)
+
+
 # main routine that gathers and outputs the reports
 def run_it():
     args = cli()
+    if args.profile:
+        start_profile(args.profile)
+    set_proc_root(args.proc_root)
+    if args.memory_contexts or (args.reports and 'query' in args.reports):
+        args.postgres_query = True
     if args.output_file != 'stdout':
-        if args.csv_output is None:
-            print '[WARNING] Cannot emit process table to file unless it is in CSV format.'
+        if not structured_output(args):
+            print '[WARNING] Cannot emit process table to file unless it is in CSV or JSON format.'
             return
 
+    if (args.headroom or args.system) and \
+            (args.cgroup or args.pgdata or args.postmaster_pid) and \
+            get_args_cgroup_dir(args) is None:
+        print '[ERROR] The cgroup v2 to report was not found.'
+        sys.exit(1)
+
+    if args.headroom:
+        out, write_header = open_output(args)
+        try:
+            output_system_memory(args, out, write_header)
+        finally:
+            close_output(out)
+        return
+
+    if args.system and (structured_output(args) or args.interval or args.diff or
+                        args.history_report or args.exporter_port or args.watch or
+                        args.pressure_trigger or args.events or
+                        args.cpu_load is not None):
+        print '[ERROR] "--system" is only shown with the text output of a single run, use "--headroom" for CSV/JSON.'
+        sys.exit(1)
+
+    if args.history_report:
+        if not args.history_file:
+            print '[ERROR] "--history-report" needs the "--history" file to read.'
+            sys.exit(1)
+        run_history_report(args)
+        return
+
+    if args.diff:
+        run_diff(args)
+        return
+
+    if args.exporter_port:
+        run_exporter(args)
+        return
+
+    if args.watch:
+        run_watch(args)
+        return
+
+    if args.pressure_trigger:
+        run_pressure(args)
+        return
+
+    if args.events:
+        run_events(args)
+        return
+
+    if args.cpu_load is not None:
+        run_cpu_load(args)
+        return
+
+    if args.interval:
+        # the rate table has no query columns
+        if args.reports or args.pss or args.postgres_query:
+            print '[ERROR] "-r", "-p", "-m" and "--pss" are not supported with "-i".'
+            sys.exit(1)
+        run_sampling(args)
+        return
+
     # stat_map is created as follows:
-    # - we iterate over all process data and their status_mem-hash
+    # - we iterate over all process data and their status_mem-columns
     #   we insert the keys into statusMap-hash
     #   convert the statusMap into a list
     #   sort it
     stat_map = {}
-    pinfos = get_process_infos()
+    result_rows_limit = None
+    if args.lines_of_output and int(args.lines_of_output) > 0:
+        result_rows_limit = int(args.lines_of_output)
+
+    # with "-n" only the top processes by URES are shown, so rank every
+    # process by reading statm alone and collect the rest of the details
+    # (and the query) only for those. this needs all of the processes for
+    # the sum, the reports and the PSS ordering, so it is not used there.
+    ranked_ures_sum = None
+    if result_rows_limit and not (args.sum_only or args.reports or args.pss):
+        mark = profile_begin()
+        pids = discover_pids(args)
+        profile_end('discovery', mark)
+        mark = profile_begin()
+        pids, ranked_ures_sum = rank_pids_by_ures(pids, result_rows_limit,
+                                                  get_filter_uid(args))
+        profile_end('ranking', mark)
+        pinfos = get_process_infos(args, pids)
+    else:
+        pinfos = get_process_infos(args)
+    record_history(args, pinfos)
 
     # we now need to organize the list of entries according to their ures
     # for this we'll create a list with two entries:
     # [ures, pid]
     # (since pid can be used to access the process from the pinfos-hash)
+    # with --pss the rows are organized by the proportional set size instead
     plist = []
     max_cpu = 0
     ures_sum = 0
     for pid, v in pinfos.items():
-        max_cpu = max(max_cpu, v["cpu"])
-        plist.append((v["ures"], pid))
-        status_mem = v["status_mem"]
-        ures_sum += int(v["ures"])
-        # add the keys from this process status_mem
-        if status_mem:
-            for k in status_mem.keys():
-                stat_map[k] = None
+        max_cpu = max(max_cpu, v.cpu)
+        if args.pss:
+            mem = (v.smaps or {}).get("PSS", 0)
+        else:
+            mem = v.ures
+        plist.append((mem, pid))
+        ures_sum += int(mem)
+        # add the columns this process has
+        for k in v.status_labels():
+            stat_map[k] = None
+
+    if ranked_ures_sum is not None:
+        ures_sum = ranked_ures_sum
+
+    sum_label = 'Unique Resident Memory sum: '
+    if args.pss:
+        sum_label = 'Proportional Set Size sum: '
 
     # If user only wants the sum, print that and exit
     if args.sum_only:
-        msg = 'Unique Resident Memory sum: ' + str(ures_sum) + ' Kilobytes'
+        msg = sum_label + str(ures_sum) + ' Kilobytes'
         if args.user:
             msg += ', for user ' + str(args.user)
         print msg
+        if args.pss:
+            print_smaps_rollup_cost()
+        if args.system:
+            output_system_memory(args)
+        return
+
+    if args.reports:
+        # a report asked for twice is only output once
+        reports = [r for i, r in enumerate(args.reports) if r not in args.reports[:i]]
+        mark = profile_begin()
+        aggregates = get_aggregates(pinfos, reports, args.pss)
+        profile_end('sorting', mark)
+        mark = profile_begin()
+        out, write_header = open_output(args)
+        try:
+            output_aggregates(aggregates, reports, args, out, write_header)
+        finally:
+            close_output(out)
+        profile_end('formatting', mark)
+        if args.system:
+            output_system_memory(args)
         return
 
     # use two steps in order to work on older pythons (newer ones
     # can use reverse=True keyparam)
+    mark = profile_begin()
     plist.sort()
     plist.reverse()
+    profile_end('sorting', mark)
 
     # prepare the stat_map
     stat_map = stat_map.keys()
@@ -549,75 +3890,49 @@ def run_it():
     time_header = ["epoch_time"]
     cpu_header = "CPU"
     main_header = ["PID", "UID", "URES", "SHR", "VIRT"]
+    if args.pss:
+        main_header += ["PSS", "USS"] + [label for dummy, label in SMAPS_ROLLUP_MAP[1:]]
     post_header = ["MINFLT", "MAJFLT", cpu_header, "threads", "started", "S", "CMD"]
     stat_header = map(lambda x: x.lower(), stat_map)
     query_header = []
 
-    result_rows_limit = None
-    if args.lines_of_output and args.lines_of_output > 0:
-        result_rows_limit = args.lines_of_output
-
-    get_current_time=False
+    # the rows have the query fields with "-p", even when no row has a query
     if args.postgres_query:
-        i=0
-        j=0
-        for dummy, pid in plist:
-            # Only iterate result_rows_limit, if args.lines_of_output was supplied.
-            if not result_rows_limit or (result_rows_limit and j < int(result_rows_limit)):
-                row = get_process_row(pinfos[pid], stat_map, max_cpu > 0, args, get_current_time=get_current_time)
-                if len(row[-1]) > 0:
-                    i += 1
-                if i > 0:
-                    query_header = ['qry_state','qry_waiting','query']
-            j += 1
-
-    if args.csv_output is None:
+        query_header = ['qry_state','qry_waiting','query']
+    if args.memory_contexts:
+        query_header = ['ctx_used', 'ctx_top'] + query_header
+
+    mark = profile_begin()
+    if not structured_output(args):
         process_table = JustifiedTable()
         process_table.add_row(main_header + stat_header + post_header + query_header)
+        for dummy, pid in plist[:result_rows_limit]:
+            process_table.add_row(get_process_row(pinfos[pid], stat_map, max_cpu > 0, args))
+        process_table.output(None)
+        profile_end('formatting', mark)
+        msg = sum_label + str(ures_sum) + ' Kilobytes'
+        if args.user:
+            msg += ', for user ' + str(args.user)
+        print msg
+        if args.pss:
+            print_smaps_rollup_cost()
+        if args.system:
+            output_system_memory(args)
+        return
 
-    # Clear the file if one was supplied
+    # stream the rows through one handle, all rows of the run carry the
+    # same timestamp
+    out, write_header = open_output(args)
     try:
-        if args.output_file != 'stdout':
-            with open(args.output_file, 'w') as fout:
-                fout.truncate()
-    except IOError as err:
-        print 'Attempted to write to ' + args.output_file + '. Error: ' + err.strerror
-        sys.exit(1)
-
-    i = 0
-    j=0
-    if args.csv_output is not None:
-        get_current_time=True
-    for dummy, pid in plist:
-        if not result_rows_limit or (result_rows_limit and j < int(result_rows_limit)):
-            row = get_process_row(pinfos[pid], stat_map, max_cpu > 0, args, get_current_time=get_current_time)
-            if args.csv_output is not None:
-                # Write to file if one was defined.
-                if args.output_file != 'stdout':
-                    with open(args.output_file, 'ab') as csvfile:
-                        csvwriter = csv.writer(csvfile)
-                        if i == 0:
-                            csvwriter.writerow(time_header + main_header + stat_header + post_header + query_header)
-
-                        csvwriter.writerow(map(str, row))
-                else:
-                    csvstdout = csv.writer(sys.stdout)
-                    if i == 0:
-                        csvstdout.writerow(time_header + main_header + stat_header + post_header + query_header)
-                    csvstdout.writerow(map(str, row))
-            else:
-                process_table.add_row(row)
-            i += 1
-            j += 1
-
-    # Write to stdout or to file
-    if args.output_file == 'stdout':
-        if args.csv_output is None:
-            process_table.output(None)
-            msg = 'Unique Resident Memory sum: ' + str(ures_sum) + ' Kilobytes'
-            if args.user:
-                msg += ', for user ' + str(args.user)
-            print msg
+        writer = RowWriter(out, time_header + main_header + stat_header + post_header + query_header,
+                           args.json_output, write_header)
+        now = time.time()
+        for dummy, pid in plist[:result_rows_limit]:
+            writer.write_row(get_process_row(pinfos[pid], stat_map, max_cpu > 0, args,
+                                             get_current_time=True, now=now))
+    finally:
+        close_output(out)
+    profile_end('formatting', mark)
 
 
 if __name__ == '__main__':
@@ -654,4 +3969,99 @@ python /tmp/pg_meminfo.py --output /tmp/foo_a.csv
 # Output 10 rows of csv (including header) without error
 python /tmp/pg_meminfo.py -c --postgres-query -u postgres -n 10
 
+# Report PSS/USS from smaps_rollup, sorted by PSS, and the PSS sum only
+python /tmp/pg_meminfo.py -u postgres --pss
+python /tmp/pg_meminfo.py -u postgres --pss -s
+
+# Only look at the processes of the cluster in this data directory
+python /tmp/pg_meminfo.py -D /var/lib/postgresql/10/main
+
+# Memory per postgres backend type and per user@database
+python /tmp/pg_meminfo.py -u postgres -r type -r database
+
+# Process titles of older releases are typed too, should print
+# [('background writer', None), ('walwriter', None), ('client backend', 'app@process')]
+cd /tmp && python -c 'import pg_meminfo; print [pg_meminfo.classify_process(t) for t in ("postgres: writer process", "postgres: wal writer process", "postgres: app process [local] idle")]'
+
+# Append JSON Lines to a file, one sample per minute from cron
+python /tmp/pg_meminfo.py -u postgres -J -a -o /tmp/pg_meminfo.jsonl
+
+# Serve Prometheus metrics on port 9187, refreshed every 10 seconds
+python /tmp/pg_meminfo.py -u postgres --exporter-port 9187 -i 10
+
+# Same, with the memory of the backends summed per query fingerprint
+python /tmp/pg_meminfo.py -u postgres --exporter-port 9187 -i 10 -r query
+
+# Keep a history of every sample, then report peak/average/growth per
+# pid, or per backend type, for the last hour
+python /tmp/pg_meminfo.py -u postgres -i 10 --history /var/tmp/pg_meminfo.hist
+python /tmp/pg_meminfo.py --history /var/tmp/pg_meminfo.hist --history-report --since 3600
+python /tmp/pg_meminfo.py --history /var/tmp/pg_meminfo.hist --history-report -r type
+
+# Benchmark the collection over synthetic /proc trees of 1k, 10k and 50k
+# processes, then look at one of the trees like at a real /proc
+python pg_meminfo_bench.py --tree-dir /tmp/pg_meminfo_bench
+python /tmp/pg_meminfo.py --proc-root /tmp/pg_meminfo_bench/10000 -r type
+
+# Report backends growing faster than 50MB/s or beyond 2GB, with the query
+python /tmp/pg_meminfo.py -u postgres --watch -p --growth-rate 51200 --ures-limit 2097152
+
+# Show the memory contexts of the 5 biggest backends next to their query
+python /tmp/pg_meminfo.py -u postgres -n 5 -m
+
+# The pid of a log line is found with any log_line_prefix, should print 4242
+cd /tmp && python -c 'import pg_meminfo; print pg_meminfo.get_log_pid_pattern("%m (%p) ").match("2026-10-17 04:00:00.000 UTC (4242) LOG:  Grand total").group(1)'
+
+# Memory per cluster on a host with several clusters, and the queries of
+# all of them, each cluster being asked for its own backends
+python /tmp/pg_meminfo.py -u postgres -r cluster
+python /tmp/pg_meminfo.py -u postgres --all-clusters -p -c
+
+# URES sum with the headroom of the host and of the postgres cgroup, and
+# only the headroom (no process scan) as JSON for a health check
+python /tmp/pg_meminfo.py -u postgres -s --system -D /var/lib/postgresql/16/main
+python /tmp/pg_meminfo.py --headroom -J --cgroup /system.slice/postgresql.service
+
+# Scan /proc with 8 threads, or with 8 processes
+python /tmp/pg_meminfo.py -u postgres -j 8
+python /tmp/pg_meminfo.py -u postgres -j 8 --pool process
+
+# Sample every 5 seconds, 12 times, showing the top 20 growers
+python /tmp/pg_meminfo.py -u postgres -i 5 --count 12 -n 20
+
+# Sample every second and append the rates to a CSV file until interrupted
+python /tmp/pg_meminfo.py -u postgres -i 1 -c -a -o /tmp/rates.csv
+
+# What changed between two captures, per process and per program, with
+# the captures sorted by PID first so they are merged in constant memory
+python /tmp/pg_meminfo.py -u postgres -c -o /tmp/before.csv
+python /tmp/pg_meminfo.py -u postgres -c -o /tmp/after.csv
+python /tmp/pg_meminfo.py --diff /tmp/before.csv /tmp/after.csv -n 20
+(head -1 /tmp/before.csv; tail -n +2 /tmp/before.csv | sort -t, -k2n) > /tmp/before.sorted.csv
+(head -1 /tmp/after.csv; tail -n +2 /tmp/after.csv | sort -t, -k2n) > /tmp/after.sorted.csv
+python /tmp/pg_meminfo.py --diff /tmp/before.sorted.csv /tmp/after.sorted.csv -r program
+
+# Capture every process with its query when the memory of the postgres
+# cgroup is under pressure (at least 100ms stalled in 2s), plus 5 samples
+# a second apart, at most every 5 minutes
+python /tmp/pg_meminfo.py -D /var/lib/postgresql/16/main --pressure-trigger 'some 100000 2000000' --pressure-dir /var/tmp --burst 5 --cooldown 300
+
+# Report every backend of the cluster that exits, with its lifetime and
+# peak memory, following forks and exits instead of rescanning /proc
+python /tmp/pg_meminfo.py -D /var/lib/postgresql/16/main --events -c -o /tmp/exits.csv -a
+
+# Where the time of a run goes, and a JSON line per run to keep an eye on
+python /tmp/pg_meminfo.py -u postgres -n 20 --profile
+python /tmp/pg_meminfo.py -u postgres -c -o /tmp/pg_mem.csv --profile /tmp/pg_meminfo_profile.json
+
+# Memory and faults per query shape over all of the backends
+python /tmp/pg_meminfo.py -u postgres -r query
+
+# CPU% of the 10 busiest postgres processes over 2 seconds, with the load
+# per backend type, core and NUMA node
+python /tmp/pg_meminfo.py -u postgres --cpu-load 2 -n 10
+
+# The collection from another script, without the command line
+cd /tmp && python -c 'import pg_meminfo; print sorted((p.ures, p.pid) for p in pg_meminfo.get_process_infos(pg_meminfo.CollectOptions(user="postgres", pss=True)).values())[-5:]'
+
 '''
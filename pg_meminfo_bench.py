@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+#
+# Benchmark of the pg_meminfo.py collection over synthetic /proc trees.
+#
+# Builds fake procfs trees with a postmaster, its auxiliary processes,
+# client backends and some unrelated processes, with status, stat, statm,
+# cmdline, smaps_rollup and task/ entries, then times every phase of a
+# pg_meminfo.py run (discovery, parsing, sorting, formatting) for each
+# output mode, and reports processes scanned per second and the peak RSS.
+#
+# Every case runs in its own child process, so the peak RSS is that of
+# the case alone.
+#
+# Current verison is not compatible with Python 3
+#
+
+'''
+import os
+import sys
+import time
+import argparse
+import resource
+import shutil
+import multiprocessing
+
+import pg_meminfo
+
+# sizes of the trees that are benchmarked by default
+SIZES = [1000, 10000, 50000]
+# the output modes that are benchmarked
+MODES = ['table', 'csv', 'json', 'report', 'sum']
+# pid of the postmaster of the synthetic cluster
+POSTMASTER_PID = 1000
+# auxiliary processes of the synthetic cluster
+AUX_TITLES = [
+    'postgres: checkpointer',
+    'postgres: background writer',
+    'postgres: walwriter',
+    'postgres: autovacuum launcher',
+    'postgres: logical replication launcher',
+    'postgres: walsender repl 10.0.0.2(40112) streaming 3A/1C2E0F8']
+
+STATUS_TEMPLATE = '''Name:\t%(comm)s
+Umask:\t0077
+State:\tS (sleeping)
+Tgid:\t%(pid)d
+Ngid:\t0
+Pid:\t%(pid)d
+PPid:\t%(ppid)d
+TracerPid:\t0
+Uid:\t26\t26\t26\t26
+Gid:\t26\t26\t26\t26
+FDSize:\t64
+Groups:\t26
+VmPeak:\t%(vmpeak)8d kB
+VmSize:\t%(vmsize)8d kB
+VmLck:\t       0 kB
+VmPin:\t       0 kB
+VmHWM:\t%(hwm)8d kB
+VmRSS:\t%(rss)8d kB
+RssAnon:\t%(anon)8d kB
+RssFile:\t    9784 kB
+RssShmem:\t%(shmem)8d kB
+VmData:\t    4100 kB
+VmStk:\t     132 kB
+VmExe:\t    7408 kB
+VmLib:\t   13060 kB
+VmPTE:\t     304 kB
+VmSwap:\t       0 kB
+HugetlbPages:\t       0 kB
+CoreDumping:\t0
+Threads:\t1
+SigQ:\t0/15587
+SigPnd:\t0000000000000000
+ShdPnd:\t0000000000000000
+SigBlk:\t0000000000000000
+SigIgn:\t0000000001301800
+SigCgt:\t0000000180006287
+CapInh:\t0000000000000000
+CapPrm:\t0000000000000000
+CapEff:\t0000000000000000
+CapBnd:\t000001ffffffffff
+CapAmb:\t0000000000000000
+NoNewPrivs:\t0
+Seccomp:\t0
+Cpus_allowed:\tff
+Cpus_allowed_list:\t0-7
+Mems_allowed:\t00000000,00000001
+Mems_allowed_list:\t0
+voluntary_ctxt_switches:\t%(vcsw)d
+nonvoluntary_ctxt_switches:\t3
+'''
+
+SMAPS_ROLLUP_TEMPLATE = '''55d1c8a00000-7ffd1d5f8000 ---p 00000000 00:00 0                          [rollup]
+Rss:            %(rss)8d kB
+Pss:            %(pss)8d kB
+Pss_Anon:       %(anon)8d kB
+Pss_File:           1200 kB
+Pss_Shmem:      %(pss_shmem)8d kB
+Shared_Clean:       8600 kB
+Shared_Dirty:   %(shmem)8d kB
+Private_Clean:      1184 kB
+Private_Dirty:  %(anon)8d kB
+Referenced:     %(rss)8d kB
+Anonymous:      %(anon)8d kB
+LazyFree:              0 kB
+AnonHugePages:         0 kB
+ShmemPmdMapped:        0 kB
+FilePmdMapped:         0 kB
+Shared_Hugetlb:        0 kB
+Private_Hugetlb:       0 kB
+Swap:                  0 kB
+SwapPss:               0 kB
+Locked:                0 kB
+'''
+
+
+# utility to write a file of the synthetic tree
+def write_file(path, data):
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+
+
+# utility to write the entries of one synthetic process
+def write_process(root, pid, ppid, cmdline, starttime, children=()):
+    comm = os.path.basename(cmdline.split(' ', 1)[0]).rstrip(':')[:15]
+    pdir = os.path.join(root, str(pid))
+    os.mkdir(pdir)
+    os.makedirs(os.path.join(pdir, 'task', str(pid)))
+    # memory in kilobytes, backends differ by how much they touched
+    anon = 2000 + (pid * 7919) % 60000
+    shmem = 1000 + (pid * 104729) % 400000
+    rss = anon + shmem + 9784
+    vmsize = 320000 + shmem
+    values = {'comm': comm, 'pid': pid, 'ppid': ppid, 'vmpeak': vmsize + 4096,
+              'vmsize': vmsize, 'hwm': rss + 1024, 'rss': rss, 'anon': anon,
+              'shmem': shmem, 'vcsw': pid % 977,
+              'pss': anon + shmem / 40 + 1200, 'pss_shmem': shmem / 40}
+    page_kb = pg_meminfo.PAGE_SIZE / 1024
+    write_file(os.path.join(pdir, 'statm'), '%d %d %d 1852 0 1058 0\n' % (
+        vmsize / page_kb, rss / page_kb, (shmem + 9784) / page_kb))
+    write_file(os.path.join(pdir, 'status'), STATUS_TEMPLATE % values)
+    write_file(os.path.join(pdir, 'smaps_rollup'), SMAPS_ROLLUP_TEMPLATE % values)
+    write_file(os.path.join(pdir, 'stat'),
+               '%d (%s) S %d %d %d 0 -1 4194560 %d 0 %d 0 %d %d 0 0 20 0 1 0 '
+               '%d %d %d 18446744073709551615 1 1 0 0 0 0 4194304 19935232 '
+               '536883719 0 0 0 17 %d 0 0 0 0 0 0 0 0 0 0 0 0 0\n' % (
+                   pid, comm, ppid, ppid, ppid, 3000 + pid % 5000, pid % 13,
+                   pid % 400, pid % 90, starttime, vmsize * 1024, rss / 4,
+                   pid % 8))
+    # postgres processes overwrite their argv with the process title,
+    # everything else has its arguments separated by NULs
+    if not cmdline.startswith('postgres: '):
+        cmdline = cmdline.replace(' ', '\x00')
+    write_file(os.path.join(pdir, 'cmdline'), cmdline + '\x00')
+    write_file(os.path.join(pdir, 'task', str(pid), 'children'),
+               ''.join('%d ' % child for child in children))
+
+
+# build a synthetic /proc tree of nprocs processes under root
+# one in ten processes is unrelated to the cluster, the others are the
+# postmaster, its auxiliary processes and client backends
+def generate_proc_tree(root, nprocs):
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+    write_file(os.path.join(root, 'uptime'), '864000.00 6000000.00\n')
+
+    others = nprocs / 10
+    backends = max(0, nprocs - others - 1 - len(AUX_TITLES))
+    child_pids = range(POSTMASTER_PID + 1,
+                       POSTMASTER_PID + 1 + len(AUX_TITLES) + backends)
+    write_process(root, POSTMASTER_PID, 1,
+                  '/usr/lib/postgresql/16/bin/postgres -D /var/lib/postgresql/16/main',
+                  1000, child_pids)
+    for i, pid in enumerate(child_pids):
+        if i < len(AUX_TITLES):
+            title = AUX_TITLES[i]
+        else:
+            title = 'postgres: app%d shop%d 10.0.%d.%d(%d) idle' % (
+                i % 5, i % 3, i % 250, i % 200, 30000 + i % 30000)
+        write_process(root, pid, POSTMASTER_PID, title, 2000 + i)
+    for i in range(others):
+        write_process(root, 200000 + i, 1, '/usr/sbin/service-%d --foreground' % (i % 40), 500 + i)
+
+
+# the pg_meminfo.py arguments of each output mode. the query report is
+# left out of "report", it needs a database to query.
+MODE_ARGS = {
+    'table': [],
+    'csv': ['-c'],
+    'json': ['-J'],
+    'report': sum((['-r', report] for report in pg_meminfo.REPORTS
+                   if report != 'query'), []),
+    'sum': ['-s'],
+}
+# the phases of a run that are reported, as timed by "--profile"
+PHASES = ['discovery', 'parsing', 'sorting', 'formatting']
+
+
+# time one case in the current process and return the results
+# the case is a whole pg_meminfo.py run (run_it) over the synthetic tree,
+# with its output thrown away, and its phases are timed by the profile
+# of "--profile"
+def run_case(root, mode, jobs):
+    argv = ['pg_meminfo.py', '--proc-root', root, '-j', str(jobs)] + MODE_ARGS[mode]
+    pg_meminfo.PROFILE = pg_meminfo.Profile()
+    saved_argv, sys.argv = sys.argv, argv
+    saved_stdout, sys.stdout = sys.stdout, open(os.devnull, 'wb')
+    try:
+        pg_meminfo.run_it()
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved_stdout
+        sys.argv = saved_argv
+    phases = []
+    for phase in PHASES:
+        entry = pg_meminfo.PROFILE.phases.get(phase)
+        secs = 0.0
+        if entry is not None:
+            secs = entry[1]
+        phases.append((phase, secs))
+
+    scanned = len(pg_meminfo.get_pids())
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return scanned, phases, peak_rss
+
+
+# child process side of run_case, sends the results back through a pipe
+def run_case_child(conn, root, mode, jobs):
+    try:
+        conn.send(run_case(root, mode, jobs))
+    except Exception as err:
+        conn.send(err)
+    conn.close()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='pg_meminfo benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='Number of processes of the synthetic trees. '
+                        'Default is %s.' % ' '.join(map(str, SIZES)))
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES,
+                        help='Output modes to benchmark. Default is all.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of scanning threads. Default is 1.')
+    parser.add_argument('--tree-dir', type=str, default='/tmp/pg_meminfo_bench',
+                        help='Where the synthetic trees are built. Existing '
+                        'trees of the same size are reused.')
+    parser.add_argument('--regenerate', action='store_true', default=False,
+                        help='Rebuild the trees even if they exist.')
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+    header = ['PROCS', 'MODE', 'PROCS/s', 'PEAK-RSS'] + PHASES
+    table = pg_meminfo.JustifiedTable()
+    table.add_row(header)
+    for size in args.sizes:
+        root = os.path.join(args.tree_dir, str(size))
+        if args.regenerate or not os.path.exists(os.path.join(root, 'uptime')):
+            started = time.time()
+            generate_proc_tree(root, size)
+            print >> sys.stderr, 'built %d processes in %s in %.1fs' % (
+                size, root, time.time() - started)
+        for mode in args.modes:
+            parent, child = multiprocessing.Pipe(False)
+            proc = multiprocessing.Process(target=run_case_child,
+                                           args=(child, root, mode, args.jobs))
+            proc.start()
+            result = parent.recv()
+            proc.join()
+            if isinstance(result, Exception):
+                print >> sys.stderr, '[ERROR] %d %s: %s' % (size, mode, result)
+                continue
+            scanned, phases, peak_rss = result
+            total = sum(secs for name, secs in phases)
+            table.add_row([scanned, mode, '%.0f' % (scanned / total),
+                           '%dkB' % peak_rss] +
+                          ['%.1fms' % (secs * 1000) for name, secs in phases])
+    table.output(None)
+
+
+if __name__ == '__main__':
+    main()
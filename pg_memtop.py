@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+#
+# Interactive, top-like view of the memory of the postgres processes,
+# built on the pg_meminfo.py collection.
+#
+# Refreshes every interval with the URES, SHR, fault rate and CPU% of
+# every process and, with "-p", the query of the backends from one
+# pg_stat_activity snapshot per refresh.
+#
+# Only the rows that fit on the screen are sorted out (with a partial
+# sort) and formatted, and only the screen lines that changed since the
+# previous refresh are redrawn, so it stays responsive with thousands of
+# backends.
+#
+# Keys:
+#   m s f c   sort by URES, SHR, fault rate or CPU%
+#   u         filter by user (empty to show all)
+#   t         filter by backend type, eg. "client backend" (empty for all)
+#   x         clear the filters
+#   p         toggle between the command line and the query
+#   up/down, page up/down, home   scroll
+#   q         quit
+#
+# Current verison is not compatible with Python 3
+#
+
+'''
+import time
+import heapq
+import argparse
+import curses
+
+import pg_meminfo
+
+# default refresh interval in seconds
+INTERVAL = 2
+# the sort orders and their keys, sort key -> (label, key of a rate)
+SORT_KEYS = {
+    'm': ('URES', lambda r: r["pinfo"].ures),
+    's': ('SHR', lambda r: r["pinfo"].shared),
+    'f': ('FLT/s', lambda r: r["minflt_rate"] + r["majflt_rate"]),
+    'c': ('CPU%', lambda r: r["utime_pct"] + r["stime_pct"]),
+}
+# "-s" values and the sort keys they select
+SORT_OPTIONS = {'ures': 'm', 'shr': 's', 'faults': 'f', 'cpu': 'c'}
+# lines above and below the process rows
+HEADER_LINES = 3
+FOOTER_LINES = 1
+ROW_FORMAT = '%7s %-10.10s %-20.20s %9s %9s %8s %6s %1s %s'
+
+
+# the state of the view: the latest sample, the sort order, filters and
+# scroll position, and the lines that are on the screen
+class MemTop:
+    def __init__(self, args, sort='m', show_query=False):
+        self.args = args
+        self.sort = sort
+        self.show_query = show_query
+        self.user = None
+        self.backend_type = None
+        self.offset = 0
+        self.cache = pg_meminfo.ProcessCache()
+        self.pinfos = {}
+        self.sampled = None
+        self.rates = []
+        # the first sample has no previous one to take the rates against
+        self.has_rates = False
+        self.error = None
+        # the lines on the screen, to only redraw the ones that changed
+        self.drawn = []
+
+    # take a sample and compute the rates since the previous one, the
+    # rates of the first sample are not shown
+    def sample(self):
+        pinfos = pg_meminfo.get_process_infos(self.args, cache=self.cache,
+                                              status=False)
+        now = time.time()
+        if self.show_query:
+            self.attach_queries(pinfos)
+        elapsed = 0
+        self.has_rates = self.sampled is not None
+        if self.has_rates:
+            elapsed = now - self.sampled
+        self.rates = pg_meminfo.get_process_rates(self.pinfos, pinfos, elapsed)
+        self.pinfos = pinfos
+        self.sampled = now
+
+    # one pg_stat_activity snapshot for all of the processes, an error is
+    # shown on the status line rather than ending the view
+    def attach_queries(self, pinfos):
+        self.error = None
+        try:
+            import psycopg2
+        except ImportError:
+            self.error = 'psycopg2 is required to retrieve the queries'
+            return
+        args = self.args
+        dsn = pg_meminfo.get_postgres_dsn(args.pg_dbname, args.pg_user,
+                                          args.pg_host, args.pg_port)
+        uptime = pg_meminfo.parse_delim_file(pg_meminfo.PROC_ROOT + "/uptime")[0]
+        boot_time = time.time() - float(uptime)
+        try:
+            activity, contexts = pg_meminfo.get_postgres_activity(dsn=dsn)
+        except psycopg2.DatabaseError as err:
+            self.error = str(err).strip()
+            return
+        pg_meminfo.match_postgres_activity(pinfos, activity, boot_time)
+
+    # the processes that pass the filters
+    def filtered(self):
+        for rate in self.rates:
+            pinfo = rate["pinfo"]
+            if self.user is not None and \
+                    pg_meminfo.NAME_CACHE.get_uid(pinfo.uid) != self.user:
+                continue
+            if self.backend_type is not None and \
+                    pg_meminfo.get_backend_type(pinfo) != self.backend_type:
+                continue
+            yield rate
+
+    # the lines of the screen, only the visible rows are sorted out and
+    # formatted
+    def get_lines(self, height, width):
+        rows = max(0, height - HEADER_LINES - FOOTER_LINES)
+        rates = list(self.filtered())
+        self.offset = max(0, min(self.offset, len(rates) - rows))
+        label, key = SORT_KEYS[self.sort]
+        if not self.has_rates and self.sort in ('f', 'c'):
+            key = SORT_KEYS['m'][1]
+        visible = heapq.nlargest(self.offset + rows, rates, key=key)[self.offset:]
+
+        ures_sum = sum(r["pinfo"].ures for r in rates)
+        filters = []
+        if self.user is not None:
+            filters.append('user=' + self.user)
+        if self.backend_type is not None:
+            filters.append('type=' + self.backend_type)
+        status = ''
+        if self.error is not None:
+            status = '[WARNING] ' + self.error
+        text_header = 'CMD'
+        if self.show_query:
+            text_header = 'QUERY'
+        lines = [
+            'pg_memtop %s  processes: %d  URES sum: %d kB  sort: %s  %s' % (
+                time.strftime("%H:%M:%S", time.localtime(self.sampled)),
+                len(rates), ures_sum, label, ' '.join(filters)),
+            status,
+            ROW_FORMAT % ('PID', 'UID', 'TYPE', 'URES', 'SHR', 'FLT/s', 'CPU%',
+                          'S', text_header),
+        ]
+        for rate in visible:
+            pinfo = rate["pinfo"]
+            text = pinfo.cmd
+            if self.show_query and pinfo.query is not None:
+                text = pinfo.query
+            faults = ''
+            cpu = ''
+            if self.has_rates:
+                faults = '%.1f' % (rate["minflt_rate"] + rate["majflt_rate"])
+                cpu = '%.1f' % (rate["utime_pct"] + rate["stime_pct"])
+            lines.append(ROW_FORMAT % (
+                pinfo.pid, pg_meminfo.NAME_CACHE.get_uid(pinfo.uid),
+                pg_meminfo.get_backend_type(pinfo), pinfo.ures,
+                pinfo.shared, faults, cpu, pinfo.state, ' '.join(text.split())))
+        lines += [''] * (height - FOOTER_LINES - len(lines))
+        lines.append('m/s/f/c sort  u user  t type  x clear  p query  q quit')
+        # the last column of the last line can not be written to
+        return [line[:width - 1] for line in lines[-height:]]
+
+    # redraw the lines that changed since the previous refresh
+    def render(self, stdscr):
+        height, width = stdscr.getmaxyx()
+        lines = self.get_lines(height, width)
+        if len(self.drawn) != len(lines):
+            stdscr.erase()
+            self.drawn = [None] * len(lines)
+        for y, line in enumerate(lines):
+            if self.drawn[y] == line:
+                continue
+            stdscr.move(y, 0)
+            stdscr.clrtoeol()
+            stdscr.addstr(y, 0, line)
+            self.drawn[y] = line
+        stdscr.refresh()
+
+    # read a line of text on the status line, None if it is empty
+    def prompt(self, stdscr, label):
+        height, width = stdscr.getmaxyx()
+        stdscr.move(1, 0)
+        stdscr.clrtoeol()
+        stdscr.addstr(1, 0, label)
+        curses.echo()
+        curses.curs_set(1)
+        try:
+            text = stdscr.getstr(1, len(label), width - len(label) - 1).strip()
+        finally:
+            curses.noecho()
+            curses.curs_set(0)
+        self.drawn[1] = None
+        return text or None
+
+    # handle a key, returns False to quit
+    def handle_key(self, stdscr, key):
+        height, width = stdscr.getmaxyx()
+        page = max(1, height - HEADER_LINES - FOOTER_LINES)
+        if key == ord('q'):
+            return False
+        if key in map(ord, SORT_KEYS):
+            self.sort = chr(key)
+            self.offset = 0
+        elif key == ord('u'):
+            self.user = self.prompt(stdscr, 'user: ')
+            self.offset = 0
+        elif key == ord('t'):
+            self.backend_type = self.prompt(stdscr, 'backend type: ')
+            self.offset = 0
+        elif key == ord('x'):
+            self.user = None
+            self.backend_type = None
+        elif key == ord('p'):
+            self.show_query = not self.show_query
+            if self.show_query:
+                self.attach_queries(self.pinfos)
+        elif key == curses.KEY_DOWN:
+            self.offset += 1
+        elif key == curses.KEY_UP:
+            self.offset = max(0, self.offset - 1)
+        elif key == curses.KEY_NPAGE:
+            self.offset += page
+        elif key == curses.KEY_PPAGE:
+            self.offset = max(0, self.offset - page)
+        elif key == curses.KEY_HOME:
+            self.offset = 0
+        elif key == curses.KEY_RESIZE:
+            self.drawn = []
+        return True
+
+    # refresh every interval, and right away after a key
+    def run(self, stdscr):
+        curses.curs_set(0)
+        self.sample()
+        self.render(stdscr)
+        while True:
+            wait = self.sampled + self.args.interval - time.time()
+            stdscr.timeout(max(0, int(wait * 1000)))
+            key = stdscr.getch()
+            if key != -1:
+                if not self.handle_key(stdscr, key):
+                    return
+            if time.time() >= self.sampled + self.args.interval:
+                self.sample()
+            self.render(stdscr)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='pg_memtop')
+    parser.add_argument('-u', '--user', type=str,
+                        help='Only show the processes of this user. Default '
+                        'is all of them.')
+    parser.add_argument('-i', '--interval', type=float, default=INTERVAL,
+                        help='Refresh every INTERVAL seconds. Default is %s.'
+                        % INTERVAL)
+    parser.add_argument('-s', '--sort', choices=sorted(SORT_OPTIONS),
+                        default='ures',
+                        help='Initial sort order. Default is ures.')
+    parser.add_argument('-p', '--postgres-query', action='store_true',
+                        default=False,
+                        help='Show the query of the backends instead of the '
+                        'command line, see pg_meminfo.py "-p".')
+    parser.add_argument('--pg-host', type=str, default=None,
+                        help='Host or socket directory "-p" connects to. '
+                        'Default is the libpq default.')
+    parser.add_argument('--pg-port', type=int, default=None,
+                        help='Port "-p" connects to. Default is the libpq '
+                        'default.')
+    parser.add_argument('--pg-dbname', type=str, default='postgres',
+                        help='Database "-p" connects to. Default is postgres.')
+    parser.add_argument('--pg-user', type=str, default='postgres',
+                        help='User "-p" connects as. Default is postgres.')
+    parser.add_argument('-D', '--pgdata', type=str, default=None,
+                        help='Only show the processes of the cluster of this '
+                        'data directory.')
+    parser.add_argument('--proc-root', type=str, default='/proc',
+                        help='Read the processes from this directory instead '
+                        'of /proc.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of scanning threads. Default is 1.')
+    return parser.parse_args()
+
+
+def main():
+    options = cli()
+    # the collection is done by pg_meminfo, with its own options
+    args = pg_meminfo.CollectOptions(user=options.user, pgdata=options.pgdata,
+                                     jobs=options.jobs, pg_host=options.pg_host,
+                                     pg_port=options.pg_port,
+                                     pg_dbname=options.pg_dbname,
+                                     pg_user=options.pg_user)
+    args.interval = options.interval
+    pg_meminfo.set_proc_root(options.proc_root)
+
+    top = MemTop(args, SORT_OPTIONS[options.sort], options.postgres_query)
+    try:
+        curses.wrapper(top.run)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()